@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+FL Modular Grid - Control Intech or any other midi devices
+Copyright (C) 2024-2025  Tom Simonart
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Benchmark of device_Intech.py in the headless simulator (see fl_sim.py), runs without FL Studio.
+#
+# Each scenario feeds a message stream on the virtual clock and reports the script throughput
+# (messages per second of OnMidiIn time), the latency percentiles of every callback and the
+# number of midi messages sent to the controller. Message counts are deterministic, timings
+# depend on the machine.
+#
+# Usage: python bench.py [--plugin NAME] [--rate MSG_PER_S] [--repeat N] [--palette] [--dual] [--stats] [scenario...]
+
+import argparse
+import contextlib
+import io
+from time import perf_counter
+
+import fl_sim
+import instrumentation
+from fl_sim import Simulator, VirtualPlugin, button_presses, encoder_sweep, merge, percentile
+
+SYNC_CCS = range(0, (5*16)-1)
+
+
+def plugin_switch(sim: Simulator, args):
+    """Focus the plugin from another mapped plugin, then idle until every led is synced."""
+    other = next(name for name in sim.script.registry.index if name != args.plugin)
+    sim.focus(VirtualPlugin.from_mapping(other))
+    sim.elapse(1.0)
+    sim.reset_stats()
+    sim.focus(VirtualPlugin.from_mapping(args.plugin))
+    start = sim.now
+    while sim.script.sync_cursor < len(sim.script.sync_order) or sim.script.out_queue:
+        sim.elapse(fl_sim.IDLE_INTERVAL)
+    return {"sync time (ms)": (sim.now - start) * 1000}
+
+
+def encoder_sweeps(sim: Simulator, args):
+    """Fast sweeps on 4 encoders at once, alternating directions."""
+    ccs = assigned(sim)[:4]
+    detents = args.messages // len(ccs)
+    sim.run(merge(*(
+        encoder_sweep(cc, detents, args.rate / len(ccs), speed=3 if i % 2 else -3)
+        for i, cc in enumerate(ccs)
+    )))
+
+
+def slow_encoder(sim: Simulator, args):
+    """A single encoder turned one detent at a time."""
+    sim.run(encoder_sweep(assigned(sim)[0], args.messages, min(args.rate, 50)))
+
+
+def button_mash(sim: Simulator, args):
+    """Buttons pressed in turn."""
+    ccs = assigned(sim)[:8]
+    presses = args.messages // 2 // len(ccs)
+    sim.run(merge(*(
+        button_presses(cc, presses, args.rate / 2 / len(ccs), start=i / args.rate)
+        for i, cc in enumerate(ccs)
+    )))
+
+
+def unassigned(sim: Simulator, args):
+    """Encoders that are not linked to any parameter."""
+    linked = set(assigned(sim))
+    ccs = [cc for cc in SYNC_CCS if cc not in linked][:4] or [127]
+    detents = args.messages // len(ccs)
+    sim.run(merge(*(encoder_sweep(cc, detents, args.rate / len(ccs)) for cc in ccs)))
+
+
+SCENARIOS = {
+    "plugin_switch": plugin_switch,
+    "encoder_sweeps": encoder_sweeps,
+    "slow_encoder": slow_encoder,
+    "button_mash": button_mash,
+    "unassigned": unassigned,
+}
+
+
+def assigned(sim: Simulator) -> list[int]:
+    return sorted({fl_sim.decode_cc(control_id) for control_id in sim.plugin.links}) or [0]
+
+
+def run_scenario(name: str, args) -> dict:
+    with contextlib.redirect_stdout(io.StringIO()):
+        sim = Simulator(VirtualPlugin.from_mapping(args.plugin))
+        sim.script.PALETTE_LEDS = args.palette
+        sim.script.DUAL_LAYER = args.dual
+        sim.focus()
+        sim.elapse(1.0)  # Initial sync
+        sim.reset_stats()
+        if args.stats:
+            sim.script.start_instrumentation()
+        start = perf_counter()
+        extra = SCENARIOS[name](sim, args) or {}
+        wall = perf_counter() - start
+    midi_in = len(sim.latencies["OnMidiIn"])
+    busy = sum(sum(latencies) for latencies in sim.latencies.values())
+    result = {
+        "midi in": midi_in,
+        "midi out": len(sim.midi_out),
+        "msg/s": midi_in / sum(sim.latencies["OnMidiIn"]) if midi_in else 0,
+        "script time (ms)": busy * 1000,
+        "wall time (ms)": wall * 1000,
+        **extra,
+    }
+    for callback, latencies in sim.latencies.items():
+        if latencies:
+            result[callback] = (len(latencies), *(percentile(latencies, p) * 1e6 for p in (50, 95, 99)))
+    result["FL API calls"] = sum(sim.calls.values())
+    if args.stats:
+        result["stats"] = instrumentation.report(sim.script.latency_stats)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark device_Intech.py in the headless simulator.")
+    parser.add_argument("scenarios", nargs="*", help=f"scenarios to run (default: all): {', '.join(SCENARIOS)}")
+    parser.add_argument("--plugin", default="UADx SSL E Channel Strip", help="mapped plugin to focus")
+    parser.add_argument("--rate", type=float, default=1000, help="incoming midi messages per second")
+    parser.add_argument("--messages", type=int, default=2000, help="incoming midi messages per scenario")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per scenario, the fastest is reported")
+    parser.add_argument("--palette", action="store_true", help="send led colors as palette indexes")
+    parser.add_argument("--dual", action="store_true", help="update both led layers of a cc in one message")
+    parser.add_argument("--stats", action="store_true", help="also time the script functions and FL API calls")
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name!r}")
+
+    for name in args.scenarios or SCENARIOS:
+        runs = [run_scenario(name, args) for _ in range(args.repeat)]
+        result = min(runs, key=lambda run: run["script time (ms)"])
+        print(f"{name}: {SCENARIOS[name].__doc__}")
+        for key, value in result.items():
+            if isinstance(value, tuple):
+                count, p50, p95, p99 = value
+                print(f"  {key:<16} {count:>6} calls   p50 {p50:8.1f} us   p95 {p95:8.1f} us   p99 {p99:8.1f} us")
+            elif key == "stats":
+                print("  " + value.replace("\n", "\n  "))
+            elif isinstance(value, float):
+                print(f"  {key:<16} {value:>10.1f}")
+            else:
+                print(f"  {key:<16} {value:>10}")
+
+
+if __name__ == "__main__":
+    main()
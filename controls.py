@@ -0,0 +1,324 @@
+"""
+FL Modular Grid - Control Intech or any other midi devices
+Copyright (C) 2024-2025  Tom Simonart
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from dataclasses import dataclass, field, fields
+from enum import Enum, auto
+from math import log10
+from weakref import WeakValueDictionary
+
+
+# Only holds the instances still in use, a plugin table evicted from the registry LRU frees its controls
+_interned = WeakValueDictionary()
+_compared = {}  # Class -> names of its compared fields
+
+def intern_key(obj) -> tuple:
+    """Key of obj in the intern table: its compared fields, a key holding obj itself would keep it alive."""
+    cls = type(obj)
+    names = _compared.get(cls)
+    if names is None:
+        names = _compared[cls] = tuple(f.name for f in fields(cls) if f.compare)
+    return (cls, *[getattr(obj, name) for name in names])
+
+def interned(obj):
+    """Returns the shared instance equal to obj, so identical colors and controls are a single object."""
+    key = intern_key(obj)
+    shared = _interned.get(key)
+    if shared is None:
+        _interned[key] = shared = obj
+    return shared
+
+
+_presets = {}  # (r, g, b) -> LedColor preset
+
+
+def pack_rgb(r: float, g: float, b: float) -> int:
+    """Pack a color in the 14-bit wire format: 5-bit red, 5-bit green, 4-bit blue."""
+    return int(r * 31) << 9 | int(g * 31) << 4 | int(b * 15)
+
+
+@dataclass(frozen=True, slots=True, weakref_slot=True)
+class LedColor:
+    r: float = 0
+    g: float = 0
+    b: float = 0
+    # Wire value, computed once
+    packed: int = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "packed", pack_rgb(self.r, self.g, self.b))
+
+    @property
+    def rgb(self):
+        return self.r, self.g, self.b
+
+    def __str__(self):
+        return f"({self.r}, {self.g}, {self.b})"
+
+    @classmethod
+    def preset(cls, r: float, g: float, b: float) -> 'LedColor':
+        """Shared instance of a preset color, presets are kept for the whole session."""
+        color = _presets.get((r, g, b))
+        if color is None:
+            color = _presets[(r, g, b)] = interned(cls(r, g, b))
+        return color
+    
+    @classmethod
+    def off(cls):
+        return cls.preset(0, 0, 0)
+    
+    @classmethod
+    def default_button(cls):
+        return cls.preset(1, 0, 0)
+    
+    @classmethod
+    def default_encoder(cls):
+        return cls.preset(0, 0, 1)
+    
+    @classmethod
+    def white(cls):
+        return cls.preset(1, 1, 1)
+    
+    @classmethod
+    def grey(cls):
+        return cls.preset(0.5, 0.5, 0.5)
+
+    @classmethod
+    def red(cls):
+        return cls.preset(1, 0, 0)
+
+    @classmethod
+    def green(cls):
+        return cls.preset(0, 1, 0)
+    
+    @classmethod
+    def blue(cls):
+        return cls.preset(0, 0, 1)
+    
+    @classmethod
+    def yellow(cls):
+        return cls.preset(1, 1, 0)
+    
+    @classmethod
+    def cyan(cls):
+        return cls.preset(0, 1, 1)
+    
+    @classmethod
+    def magenta(cls):
+        return cls.preset(1, 0, 1)
+    
+    @classmethod
+    def orange(cls):
+        return cls.preset(1, 0.5, 0)
+    
+    @classmethod
+    def purple(cls):
+        return cls.preset(0.5, 0, 1)
+    
+    @classmethod
+    def pink(cls):
+        return cls.preset(1, 0, 0.5)
+    
+    @classmethod
+    def teal(cls):
+        return cls.preset(0, 1, 0.5)
+    
+    @classmethod
+    def lime(cls):
+        return cls.preset(0.5, 1, 0)
+    
+    @classmethod
+    def azure(cls):
+        return cls.preset(0, 0.5, 1)
+    
+    @classmethod
+    def brown(cls):
+        return cls.preset(0.5, 0.25, 0)
+    
+    @classmethod
+    def lightgreen(cls):
+        return cls.preset(0.5, 1, 0.5)
+
+
+class Curve(Enum):
+    """Led intensity response to the value of a control."""
+    LINEAR = auto()
+    LOG = auto()  # Brightens quickly at low values, useful for gains
+    BIPOLAR = auto()  # Dark at the center, bright at both ends, useful for pans
+
+    def apply(self, value: float) -> float:
+        if self is Curve.LOG:
+            return log10(1 + 9 * value)
+        if self is Curve.BIPOLAR:
+            return abs(2 * value - 1)
+        return value
+
+
+INTENSITY_MAX = 1023  # Highest quantised control value, lut index
+BEAUTIFY_CEIL = 114  # Beautified leds never go below 127 - BEAUTIFY_CEIL
+_intensity_luts = {}
+
+def intensity_lut(curve: Curve = Curve.LINEAR, invert: bool = False, beautify: bool = False) -> tuple[int, ...]:
+    """
+    Returns the table mapping a quantised control value (0 -> INTENSITY_MAX) to a 7-bit led intensity.
+    Tables are built once and shared between every control using the same mode.
+    """
+    key = (curve, invert, beautify)
+    lut = _intensity_luts.get(key)
+    if lut is None:
+        values = []
+        for q in range(INTENSITY_MAX + 1):
+            value = curve.apply(q / INTENSITY_MAX)
+            if invert:
+                value = 1 - value
+            if beautify:
+                values.append(int(value * BEAUTIFY_CEIL) + 127 - BEAUTIFY_CEIL)
+            else:
+                values.append(int(value * 127))
+        lut = tuple(values)
+        _intensity_luts[key] = lut
+    return lut
+
+
+VELOCITY_BUCKET = 5  # Width of an acceleration table bucket (detents/s)
+VELOCITY_BUCKETS = 64
+_accel_tables = {}
+
+@dataclass(frozen=True, slots=True, weakref_slot=True)
+class AccelCurve:
+    """Step multiplier of an encoder depending on its rotation speed (detents/s)."""
+    slow: float = 20  # Up to this speed, 1 step per detent
+    fast: float = 200  # From this speed, max_multiplier steps per detent
+    max_multiplier: float = 4
+    exponent: float = 2  # Shape of the curve between slow and fast
+    # Multiplier per velocity bucket, computed once
+    table: tuple[float, ...] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # Tables are built once and shared between every curve with the same parameters
+        key = (self.slow, self.fast, self.max_multiplier, self.exponent)
+        table = _accel_tables.get(key)
+        if table is None:
+            values = []
+            for bucket in range(VELOCITY_BUCKETS):
+                velocity = bucket * VELOCITY_BUCKET
+                ratio = min(max((velocity - self.slow) / (self.fast - self.slow), 0), 1)
+                values.append(1 + (self.max_multiplier - 1) * ratio ** self.exponent)
+            table = _accel_tables[key] = tuple(values)
+        object.__setattr__(self, "table", table)
+
+    def multiplier(self, velocity: float) -> float:
+        bucket = int(velocity / VELOCITY_BUCKET)
+        return self.table[bucket if bucket < VELOCITY_BUCKETS else VELOCITY_BUCKETS - 1]
+
+    @classmethod
+    def none(cls):
+        """Raw relative values from the controller, no extra acceleration."""
+        return cls(max_multiplier=1)
+
+    @classmethod
+    def gentle(cls):
+        return cls(slow=40, fast=300, max_multiplier=2)
+
+    @classmethod
+    def fast_sweep(cls):
+        return cls(slow=10, fast=150, max_multiplier=8)
+
+
+DEFAULT_ACCEL_CURVE = interned(AccelCurve())
+
+
+ANTI_GHOST_DELAY = 0.13  # Default time during which reverse movements are ignored (s)
+
+@dataclass(frozen=True, slots=True, weakref_slot=True)
+class CtrlEncoder():
+    steps: int = 255
+    accel: bool = True
+    invert: bool = False
+    invert_intensity: bool = False
+    curve: Curve = Curve.LINEAR
+    anti_ghost_delay: float = ANTI_GHOST_DELAY  # Can be below the idle interval, a reversal flushes the movement so far
+    accel_curve: AccelCurve = DEFAULT_ACCEL_CURVE  # Used when accel is enabled
+
+    def __post_init__(self):
+        if self.accel_curve is not DEFAULT_ACCEL_CURVE:
+            object.__setattr__(self, "accel_curve", interned(self.accel_curve))
+
+@dataclass(frozen=True, slots=True, weakref_slot=True)
+class CtrlButton():
+    steps: int = 2
+    invert_intensity: bool = False
+    curve: Curve = Curve.LINEAR
+
+@dataclass(frozen=True, slots=True, weakref_slot=True)
+class Control:
+    button_led: LedColor = field(default_factory=LedColor.off)
+    encoder_led: LedColor = field(default_factory=LedColor.off)
+    beautify_button: bool = True
+    beautify_encoder: bool = True
+    encoder: CtrlEncoder = field(default_factory=CtrlEncoder)
+    button: CtrlButton = field(default_factory=CtrlButton)
+    # Intensity tables, for feedback and for the background sync (always beautified)
+    button_lut: tuple[int, ...] = field(init=False, repr=False, compare=False)
+    encoder_lut: tuple[int, ...] = field(init=False, repr=False, compare=False)
+    button_sync_lut: tuple[int, ...] = field(init=False, repr=False, compare=False)
+    encoder_sync_lut: tuple[int, ...] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        shared = _interned.get(intern_key(self))
+        if shared is not None:
+            # Equal to a control in use, take its shared parts and tables
+            for name in ("button_led", "encoder_led", "encoder", "button",
+                         "button_lut", "encoder_lut", "button_sync_lut", "encoder_sync_lut"):
+                object.__setattr__(self, name, getattr(shared, name))
+            return
+        # Share the parts with every other control using the same ones
+        for name in ("button_led", "encoder_led", "encoder", "button"):
+            object.__setattr__(self, name, interned(getattr(self, name)))
+        button, encoder = self.button, self.encoder
+        object.__setattr__(self, "button_lut", intensity_lut(button.curve, button.invert_intensity, self.beautify_button))
+        object.__setattr__(self, "encoder_lut", intensity_lut(encoder.curve, encoder.invert_intensity, self.beautify_encoder))
+        object.__setattr__(self, "button_sync_lut", intensity_lut(button.curve, button.invert_intensity, True))
+        object.__setattr__(self, "encoder_sync_lut", intensity_lut(encoder.curve, encoder.invert_intensity, True))
+
+
+@dataclass(frozen=True, slots=True)
+class GridModule:
+    """A physical module of the grid, it covers 16 consecutive cc's starting at first_cc."""
+    first_cc: int
+    encoders: bool = True
+    buttons: bool = True
+
+    @property
+    def ccs(self) -> range:
+        return range(self.first_cc, self.first_cc + 16)
+
+
+# Modules on port 13 (5x EN16), cc ranges as received by the script (module position range - 32)
+GRID_LAYOUT = (GridModule(0), GridModule(16), GridModule(32), GridModule(48), GridModule(64))
+
+CONTROL_SLOTS = 128
+# Shared by every unmapped slot of every compiled table
+DEFAULT_CONTROL = interned(Control(
+    button_led=LedColor.default_button(), encoder_led=LedColor.default_encoder(),
+    beautify_button=False, beautify_encoder=False))
+
+def compile_controls(controls: dict[int, Control]) -> list[Control]:
+    """Resolve a plugin mapping into a fixed table indexed by cc, unmapped slots use DEFAULT_CONTROL."""
+    table = [DEFAULT_CONTROL] * CONTROL_SLOTS
+    for cc, control in controls.items():
+        table[cc] = interned(control)
+    return table
@@ -20,6 +20,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from enum import Enum, auto
+from math import ceil
 from time import monotonic
 from typing import Optional
 
@@ -39,78 +40,255 @@ try:
 except ImportError:
     pass
 
-from mapping import Control, LedColor, mapping
+from controls import DEFAULT_CONTROL, INTENSITY_MAX, Control, LedColor, compile_controls, intensity_lut
+import mapping_cache
 
 last_plugin = None
 last_id = None
-synced = set()  # For all the colors that were already set
-idle_synced_default = set(
-    list(range(0, (5*16)-1))
-)
-idle_synced = idle_synced_default.copy()
-last_synced = monotonic()
+synced_gen = [0] * 128  # Sync generation in which each cc color was last set
+sync_generation = 1  # Bumped to mark every cc as not synced
+SYNC_CCS = range(0, (5*16)-1)  # Every cc synced in the background
+SYNC_TIME_BUDGET = 0.004  # Max time spent syncing leds per idle tick (s)
+SYNC_MSG_BUDGET = 48  # Max midi messages sent while syncing per idle tick
+sync_order = ()  # cc's in background sync order for the focused plugin
+sync_cursor = 0  # Position of the next cc to sync in sync_order
+sync_cost = 0.0005  # Measured average time to sync one control (s)
+midi_out_count = 0  # Total midi messages sent to the controller
 control_sync = {}
+registry = mapping_cache.MappingRegistry()  # Plugin control tables, loaded on first focus
+control_table = compile_controls({})  # Table of the last plugin used
+assigned_mask = 0  # Bit n is set when cc n is assigned for the focused plugin
+
+def get_compiled_plugin(plugin) -> tuple[list[Control], int, tuple[int, ...]]:
+    """Returns the control table, assigned mask and sync order of a plugin, loading its table on first use."""
+    table = registry.get(plugin) or compile_controls({})
+    mask = 0
+    for cc, control in enumerate(table):
+        if control is not DEFAULT_CONTROL:
+            mask |= 1 << cc
+    # Assigned controls are synced first
+    order = tuple(
+        [cc for cc in SYNC_CCS if mask >> cc & 1]
+        + [cc for cc in SYNC_CCS if not mask >> cc & 1]
+    )
+    return table, mask, order
 
 def get_plugin_control(cc) -> Control:
     """Returns the mapped Control for a given cc for the last plugin used."""
-    global mapping, last_plugin
-    return mapping['plugins'].get(last_plugin, {}).get(
-        cc, Control(
-            button_led=LedColor.default_button(), encoder_led=LedColor.default_encoder(),
-            beautify_button=False, beautify_encoder=False)
-    )
+    return control_table[cc]
 
 def get_assigned_controls() -> set[int]:
-    """Returns the list of all the cc's that are assigned for the last plugin used."""
-    global mapping, last_plugin
-    controls = mapping['plugins'].get(last_plugin, {})
-    return set(controls)
+    """Returns the list of all the cc's that are assigned for the focused plugin."""
+    return {cc for cc in range(128) if assigned_mask >> cc & 1}
+
+def invalidate_sync():
+    """Mark every control as not synced and restart the background sync."""
+    global sync_generation, sync_cursor
+    sync_generation += 1
+    sync_cursor = 0
+
+MAPPING_CHECK_INTERVAL = 1.0  # Time between two checks for mapping changes on disk (s)
+last_mapping_check = 0.0
+
+def reload_mapping():
+    """
+    Reload the mapping shards that changed on disk, at most once per MAPPING_CHECK_INTERVAL.
+    Only the controls of the focused plugin that differ from the previous mapping are synced again.
+    """
+    global last_mapping_check, control_table, assigned_mask, sync_order, sync_cursor
+    now = monotonic()
+    if now < last_mapping_check + MAPPING_CHECK_INTERVAL:
+        return
+    last_mapping_check = now
+    errors = dict(registry.errors)
+    changed = registry.refresh()
+    for path, error in registry.errors.items():
+        if errors.get(path) != error:
+            print(f"Mapping not reloaded, {path}: {error[2]}")
+    if last_plugin is None or last_plugin not in changed:
+        return
+    old_table = control_table
+    control_table, assigned_mask, order = get_compiled_plugin(last_plugin)
+    if PALETTE_LEDS:
+        upload_palette(control_table)
+    changed_ccs = [cc for cc in order if control_table[cc] != old_table[cc]]
+    print(f"Mapping reloaded: {len(changed_ccs)} control(s) changed for {last_plugin}")
+    if not changed_ccs:
+        return
+    # Queue the changed controls first, in front of the ones not synced yet
+    for cc in changed_ccs:
+        synced_gen[cc] = 0
+    queued = set(changed_ccs)
+    pending = [cc for cc in sync_order[sync_cursor:] if cc not in queued]
+    sync_order = tuple(changed_ccs + pending)
+    sync_cursor = 0
+
+MIDI_TRACE = False  # Record every midi message received and sent in the traces directory, see midi_trace.py
+TRACE_FLUSH_INTERVAL = 0.5  # Time between two writes of the trace file (s)
+trace = None  # midi_trace.TraceRecorder when recording
+midi_trace = None  # Only imported when recording, midi_trace.py is optional
+last_trace_flush = 0.0
+
+def start_trace(path: str = None):
+    """Start recording the midi messages (can be called from the script console)."""
+    global trace, midi_trace
+    import midi_trace
+    stop_trace()
+    trace = midi_trace.TraceRecorder(path or midi_trace.new_trace_path())
+    print("Recording midi trace:", trace.path)
+
+def stop_trace():
+    global trace
+    if trace is not None:
+        trace.flush()
+        print(f"Midi trace saved: {trace.path} ({trace.written - trace.dropped} messages, {trace.dropped} dropped)")
+        trace = None
+
+def flush_trace():
+    global last_trace_flush
+    now = monotonic()
+    if now >= last_trace_flush + TRACE_FLUSH_INTERVAL:
+        last_trace_flush = now
+        trace.flush()
+
+INSTRUMENT = False  # Time the callbacks, hot path functions and FL API calls from the start, see instrumentation.py
+TIMED_FUNCTIONS = ("OnMidiIn", "OnIdle", "OnRefresh", "set_control_color", "set_led")
+TIMED_API = {
+    "device": ("findEventID", "getLinkedValue", "midiOutMsg"),
+    "mixer": ("automateEvent",),
+    "general": ("processRECEvent",),
+}
+latency_stats = None  # Histogram by timed function name, when instrumented
+
+def start_instrumentation():
+    """Start timing (can be called from the script console), print the results with print_stats() or shift + stop."""
+    global latency_stats
+    if latency_stats is None:
+        import instrumentation  # Optional, only needed when timing
+        latency_stats = instrumentation.instrument(globals(), TIMED_FUNCTIONS, TIMED_API)
+    else:
+        for histogram in latency_stats.values():
+            histogram.reset()
+
+def print_stats():
+    if latency_stats is None:
+        print("Instrumentation is off, call start_instrumentation() first")
+        return
+    import instrumentation
+    print(instrumentation.report(latency_stats))
+    lookups = event_id_cache_hits + event_id_cache_misses
+    print(f"Event id cache: {event_id_cache_hits}/{lookups} hits, midi out: {midi_out_count} messages")
 
 def OnInit():
     print("init")
+    # Reloads only report new errors
+    for path, error in registry.errors.items():
+        print(f"Mapping not loaded, {path}: {error[2]}")
+    if MIDI_TRACE:
+        start_trace()
+
+def OnDeInit():
+    stop_trace()
 
 def OnIdle():
-    SYNC_DELTA = 0
-    global last_plugin, idle_synced, mapping, last_synced
-    if len(idle_synced) == 0:
+    global sync_cost, sync_cursor
+    flush_encoders()
+    drain_palette()
+    drain_output()
+    flush_leds()
+    if trace is not None:
+        flush_trace()
+    reload_mapping()
+    # Hints held back by the rate limit after their refresh
+    render_hint()
+    if sync_cursor >= len(sync_order) or out_queue or palette_pending:
+        # Nothing to sync, or wait until the output budget is back
         return
-    if monotonic() < last_synced + SYNC_DELTA:
+    # Sync as many controls as fit in the budget, at least one per tick
+    start = now = monotonic()
+    deadline = start + SYNC_TIME_BUDGET
+    msg_limit = midi_out_count + SYNC_MSG_BUDGET
+    n = 0
+    while sync_cursor < len(sync_order) and (n == 0 or (now + sync_cost <= deadline and midi_out_count < msg_limit)):
+        cc = sync_order[sync_cursor]
+        sync_cursor += 1
+        set_control_color(cc, reset_intensity=True)
+        n += 1
+        now = monotonic()
+    sync_cost = 0.8 * sync_cost + 0.2 * (now - start) / n
+
+last_hint = None  # Pending (status prefix, midi status, cc, event id) to display
+hint_refreshed = False  # FL Studio refreshed the value of the pending hint since it was set
+HINT_RATE = 20  # Max hint updates per second
+hint_names = {}  # Event id -> parameter name, for the focused plugin
+hint_text = None  # Text last displayed by the script
+hint_text_time = 0.0  # Time hint_text was displayed
+hint_time = 0.0  # Time of the last hint update
+
+def set_hint(text: str):
+    """
+    Display a hint, unless it was displayed less than 1 / HINT_RATE s ago.
+    Older hints are displayed again, FL Studio may have replaced them in the meantime.
+    """
+    global hint_text, hint_text_time
+    now = monotonic()
+    if text != hint_text or now >= hint_text_time + 1 / HINT_RATE:
+        ui.setHintMsg(text)
+        hint_text = text
+        hint_text_time = now
+
+def render_hint(refreshed: bool = False):
+    """
+    Display the pending hint, at most HINT_RATE times per second.
+    The value string is only up to date once FL Studio refreshed after the automation (OnRefresh).
+    """
+    global last_hint, hint_time, hint_refreshed
+    if last_hint is None:
         return
-    cc = idle_synced.pop()
-    set_control_color(cc, reset_intensity=True)
-    last_synced = monotonic()
+    hint_refreshed = hint_refreshed or refreshed
+    if not hint_refreshed:
+        return
+    now = monotonic()
+    if now < hint_time + 1 / HINT_RATE:
+        return
+    event_id = last_hint[3]
+    value_name = hint_names.get(event_id)
+    if value_name is None:
+        value_name = device.getLinkedParamName(event_id)
+        hint_names[event_id] = value_name
+    value_str = device.getLinkedValueString(event_id)
+    set_hint(f"{last_hint[0]}CH{last_hint[1]} CC{last_hint[2]} - {value_name}: {value_str}")
+    hint_time = now
+    last_hint = None
 
-last_hint = None
 def OnRefresh(flags):
-    global last_plugin, last_id, synced, idle_synced, last_hint
+    global last_plugin, last_id, control_table, assigned_mask, sync_order
+    flush_encoders()
     plugin = ui.getFocusedPluginName()
     id_ = ui.getFocusedFormID()
+    if last_plugin != plugin:
+        # Swap the lookup table once per focus change
+        control_table, assigned_mask, sync_order = get_compiled_plugin(plugin)
+        if PALETTE_LEDS:
+            upload_palette(control_table)
+    if last_plugin != plugin or id_ != last_id or flags & midi.HW_Dirty_RemoteLinks:
+        # Linked controls may have changed
+        clear_event_id_cache()
+        hint_names.clear()
     if last_plugin != plugin and plugin != "":
         print("New plugin:", plugin)
-        synced.clear()
         # Batch clear module led intensity
-        for cc in range(0, len(idle_synced_default), 16):
-            device.midiOutMsg(0xB << 4, 2, cc, 0)
-        # Mark every non mapped controls as synced
-        synced.union(get_assigned_controls())
-        
-        idle_synced = idle_synced_default.copy()
+        reset_modules_intensity(SYNC_CCS)
+        invalidate_sync()
     elif id_ != last_id:
         print("New ID:", id_)
-        synced.clear()
-        # Mark every non mapped controls as synced
-        synced.union(get_assigned_controls())
-        idle_synced = idle_synced_default.copy()
+        invalidate_sync()
     last_plugin = plugin
     last_id = id_
+    flush_leds()
     
     # Display last hint if any, if not done here, value is not updated correctly
-    if last_hint is not None:
-        value_name = device.getLinkedParamName(last_hint[3])
-        value_str = device.getLinkedValueString(last_hint[3])
-        hint_msg = f"{last_hint[0]}CH{last_hint[1]} CC{last_hint[2]} - {value_name}: {value_str}"
-        ui.setHintMsg(hint_msg)
-        last_hint = None
+    render_hint(refreshed=True)
     
     # TODO sync back with controller, currently difficult with fl api
     # if flags & midi.HW_Dirty_RemoteLinkValues:
@@ -125,16 +303,33 @@ def OnRefresh(flags):
 def get_mapped_event_id(msg: 'FlMidiMsg') -> Optional[int]:
     return get_mapped_event_id_raw(device.getPortNumber(), msg.status & 0xF, msg.controlNum)
 
+event_id_cache = {}  # (port, channel, cc) -> event id or None when not linked
+event_id_cache_hits = 0
+event_id_cache_misses = 0
+
+def clear_event_id_cache():
+    """Drop every resolved event id, they are resolved again lazily."""
+    event_id_cache.clear()
+
 def get_mapped_event_id_raw(port, channel, cc):
+    global event_id_cache_hits, event_id_cache_misses
+    key = (port, channel, cc)
+    if key in event_id_cache:
+        event_id_cache_hits += 1
+        return event_id_cache[key]
+    event_id_cache_misses += 1
     fl_control_id = midi.EncodeRemoteControlID(port, channel, cc)
     event_id = device.findEventID(fl_control_id)
     linked_info = device.getLinkedInfo(event_id)
     if linked_info == -1:
-        return None
+        event_id = None
+    event_id_cache[key] = event_id
     return event_id
 
 def OnMidiIn(msg: 'FlMidiMsg'):
     port = device.getPortNumber()
+    if trace is not None:
+        trace.record(midi_trace.IN, msg.status, msg.data1, msg.data2, port)
     if port == 13:
         port_13(msg)
     else:
@@ -147,31 +342,25 @@ def set_control_color(cc: int, reset_intensity: bool = False):
     This method is used because syncing everything at once could result in excessive
     load on the intech modules and make FL studio lag.
     """
-    global synced, last_plugin, mapping, control_sync
-    if cc in synced:
+    if synced_gen[cc] == sync_generation:
         return
-    synced.add(cc)
+    synced_gen[cc] = sync_generation
 
     c_map = get_plugin_control(cc)
     button_event = get_mapped_event_id_raw(device.getPortNumber(), 1, cc) 
     if button_event is not None:
-        color = c_map.button_led
         intensity = device.getLinkedValue(button_event)
-        if c_map.button.invert_intensity:
-            intensity = 1 - intensity
-        set_led(1, cc, intensity, rgb=color.rgb, beautify=True)
+        button = (led_level(intensity, c_map.button_sync_lut), c_map.button_led.packed)
     else:
-        set_led(1, cc, 0)
+        button = (0, None)
 
     encoder_event = get_mapped_event_id_raw(device.getPortNumber(), 2, cc)
     if encoder_event is not None:
-        color = c_map.encoder_led
         intensity = device.getLinkedValue(encoder_event)
-        if c_map.encoder.invert_intensity:
-            intensity = 1 - intensity
-        set_led(2, cc, intensity, rgb=color.rgb, beautify=True)
+        encoder = (led_level(intensity, c_map.encoder_sync_lut), c_map.encoder_led.packed)
     else:
-        set_led(2, cc, 0) 
+        encoder = (0, None)
+    send_dual(cc, *button, *encoder)
 
 def port_13(msg: 'FlMidiMsg'):
     """Implementation for 5x intech EN16 (0,0;0,1;0,2;1,0;1,1) + 1x TEK2 (1,2)"""
@@ -192,8 +381,8 @@ def port_13(msg: 'FlMidiMsg'):
     else:
         # Set led to off
         if 1 <= midiChan <= 2:  # FIXME what's this
-            set_led(midiChan, msg.controlNum, 0)
-        ui.setHintMsg(f"CH{midiChan} CC{msg.controlNum} - Not assigned")
+            set_led(midiChan, msg.controlNum, 0, defer=True)
+        set_hint(f"CH{midiChan} CC{msg.controlNum} - Not assigned")
 
         # TODO remove this section, it was testing for the special inc/dec bug of Fl studio, got fixed with a -32 offset
         # Special case for 96 & 97
@@ -356,7 +545,10 @@ def process_daw_controls(msg: 'FlMidiMsg', event_id):
                 transport.stop()
             transport.start()
         elif msg.controlNum == STOP_BTN:
-            transport.stop()
+            if shift() and latency_stats is not None:
+                print_stats()
+            else:
+                transport.stop()
         elif msg.controlNum == SHIFT_BTN:
             daw_context['shift_key'] = True
 
@@ -404,7 +596,7 @@ def process_daw_controls(msg: 'FlMidiMsg', event_id):
     daw_context['long_press'][msg.controlNum] = (monotonic(), msg.controlVal)
 
 def process_linked_params_buttons(msg: 'FlMidiMsg', event_id):
-    global last_hint
+    global last_hint, hint_refreshed
     c_map = get_plugin_control(msg.controlNum)
 
     val = device.getLinkedValue(event_id)
@@ -412,26 +604,25 @@ def process_linked_params_buttons(msg: 'FlMidiMsg', event_id):
         new_value = get_relative_step(val, c_map.button.steps, 1, rollover=True)
         general.processRECEvent(event_id, int(new_value * midi.FromMIDI_Max), midi.REC_MIDIController)
     msg.handled = True
-    intensity = val
-    if c_map.button.invert_intensity:
-        intensity = 1 - intensity
-    set_led(msg.status & 0xF, msg.controlNum, intensity, beautify=c_map.beautify_button)
+    set_led(msg.status & 0xF, msg.controlNum, val, lut=c_map.button_lut, defer=True)
     last_hint = ("", msg.status, msg.controlNum, event_id)
+    hint_refreshed = False
 
 def get_relative_step(value: float, steps: int, speed: int, min_: float = 0.0, max_: float = 1.0, rollover=False) -> float:
     """Get the value at step diff for an encoder or button. Rollover disables clamp between min and max mode."""
     R_STEP_PRECISION = 5
+    STEP_MAX = 4095
     step_diff = (max_ - min_) / (steps - 1)
-    # Get current step
-    current_step = 0
-    LOOP_MAX = 4095
-    loop_n = 0
+    # Get current step: the first one whose rounded value is not below value
     value = round(value, R_STEP_PRECISION)
+    current_step = max(0, ceil(value / step_diff))
+    # Fix the estimate around rounding boundaries
+    while current_step > 0 and value <= round(step_diff * (current_step - 1), R_STEP_PRECISION):
+        current_step -= 1
     while value > round(step_diff * current_step, R_STEP_PRECISION):
-        if loop_n == LOOP_MAX:  # Avoid infinite loops
-            raise Exception("Infinite loop in stepper")
         current_step += 1
-        loop_n += 1 
+    if current_step > STEP_MAX:
+        raise ValueError(f"Value {value} is out of range for {steps} steps")
     
     if rollover and current_step + speed >= steps:
         speed = -1 * (current_step + speed - 1)
@@ -442,12 +633,18 @@ def get_relative_step(value: float, steps: int, speed: int, min_: float = 0.0, m
     clamped_value = round((current_step + speed) * step_diff, R_STEP_PRECISION)
     return clamped_value
 
-anti_ghost = monotonic()
-anti_ghost_cc = None
-anti_ghost_direction = 0  # -1 = counter clockwise, 1 = clockwise
-ANTI_GHOST_DELAY = 0.13
+class EncoderState:
+    """Last movement of an encoder, for the kickback filter and acceleration."""
+    __slots__ = ('last', 'direction', 'velocity')
+
+    def __init__(self):
+        self.last = 0.0  # Time of the last accepted movement
+        self.direction = 0  # -1 = counter clockwise, 1 = clockwise
+        self.velocity = 0.0  # Smoothed speed (detents/s)
+
+VELOCITY_TIMEOUT = 0.25  # Encoders idle for longer start again from 0 velocity (s)
+encoder_states = [EncoderState() for _ in range(128)]  # Indexed by cc
 def process_linked_params_encoders(msg: 'FlMidiMsg', event_id):
-    global anti_ghost, anti_ghost_direction, anti_ghost_cc, last_hint
     c_map = get_plugin_control(msg.controlNum)
     msg_val = msg.controlVal
     if msg_val < 64:
@@ -462,75 +659,338 @@ def process_linked_params_encoders(msg: 'FlMidiMsg', event_id):
         return
     
     # Filter unwanted kickbacks / ghost movements
-    if anti_ghost_direction != inc and monotonic() < anti_ghost + ANTI_GHOST_DELAY and msg.controlNum == anti_ghost_cc:
+    state = encoder_states[msg.controlNum]
+    now = monotonic()
+    if state.direction != inc and now < state.last + c_map.encoder.anti_ghost_delay:
         msg.handled = True
         return
-    anti_ghost = monotonic()
-    anti_ghost_direction = inc
-    anti_ghost_cc = msg.controlNum
+    elapsed = now - state.last
+    if elapsed > VELOCITY_TIMEOUT:
+        state.velocity = 0.0
+    else:
+        state.velocity = 0.5 * state.velocity + 0.5 * abs(speed) / max(elapsed, 0.001)
+    state.last = now
+    state.direction = inc
 
     if c_map.encoder.accel:
-        diff = speed
+        diff = int(speed * c_map.encoder.accel_curve.multiplier(state.velocity))
     else:
         diff = inc
     
     if c_map.encoder.invert:
         diff = -diff
-    try:
-        if c_map.encoder.steps >= 255:
-            mixer.automateEvent(
-                event_id,
-                diff,
-                midi.REC_MIDIController,
-                0,
-                1,
-                res=1 / (c_map.encoder.steps - 1),
-            )
-            msg.handled = True
-        else:  # Stepped mode
-            val = device.getLinkedValue(event_id)
-            new_value = get_relative_step(val, c_map.encoder.steps, diff)
-            general.processRECEvent(event_id, int(new_value * midi.FromMIDI_Max), midi.REC_MIDIController)
-            msg.handled = True
-    except RuntimeError:
-        msg.handled = False
-        hint_msg = f"CH{msg.status & 0xF} CC{msg.controlNum} - Operation Unsafe"
-        ui.setHintMsg(hint_msg)
-        return
-    
-    val = device.getLinkedValue(event_id)
-    intensity = val
-    if c_map.encoder.invert_intensity:
-        intensity = 1 - intensity
-    set_led(msg.status & 0xF, msg.controlNum, intensity, beautify=c_map.beautify_encoder)
 
-    hint_status = "^w" if inc > 0 else "^v"
-    last_hint = (hint_status, msg.status, msg.controlNum, event_id)
+    # Accumulate until the next flush, one automation per encoder per burst
+    key = (msg.status & 0xF, msg.controlNum)
+    pending = pending_encoders.get(key)
+    if pending is not None and pending[2] != inc:
+        # Reversed before the flush (anti_ghost_delay shorter than the idle interval): apply the movement so far,
+        # a burst summed in a single direction is clamped at the range ends like one message at a time
+        flush_encoders()
+        pending = pending_encoders.get(key)
+    if pending is None:
+        pending_encoders[key] = [event_id, diff, inc, msg.status]
+    else:
+        pending[0] = event_id
+        pending[1] += diff
+        pending[2] = inc
+    msg.handled = True
+
+pending_encoders = {}  # (channel, cc) -> [event id, accumulated diff, last direction, midi status]
+def flush_encoders():
+    """
+    Apply the encoder movements accumulated since the last flush, then update their leds and the hint.
+    A movement FL Studio refuses (operation unsafe) is dropped, like a single message would be.
+    """
+    global last_hint, hint_refreshed
+    if not pending_encoders:
+        return
+    for (channel, cc), (event_id, diff, inc, status) in pending_encoders.items():
+        c_map = get_plugin_control(cc)
+        try:
+            if c_map.encoder.steps >= 255:
+                mixer.automateEvent(
+                    event_id,
+                    diff,
+                    midi.REC_MIDIController,
+                    0,
+                    1,
+                    res=1 / (c_map.encoder.steps - 1),
+                )
+            else:  # Stepped mode
+                val = device.getLinkedValue(event_id)
+                new_value = get_relative_step(val, c_map.encoder.steps, diff)
+                general.processRECEvent(event_id, int(new_value * midi.FromMIDI_Max), midi.REC_MIDIController)
+        except RuntimeError:
+            hint_msg = f"CH{channel} CC{cc} - Operation Unsafe"
+            set_hint(hint_msg)
+            continue
+
+        val = device.getLinkedValue(event_id)
+        set_led(channel, cc, val, lut=c_map.encoder_lut, defer=True)
+
+        hint_status = "^w" if inc > 0 else "^v"
+        last_hint = (hint_status, status, cc, event_id)
+        hint_refreshed = False
+    pending_encoders.clear()
 
 def set_led(
         channel: int,
         cc: int,
-        intensity: float,
-        rgb: Optional[tuple[float, float, float]] = None,
-        beautify: bool = False
+        value: float,
+        color: Optional[int] = None,
+        lut: tuple[int, ...] = intensity_lut(),
+        defer: bool = False
     ):
-    BEAUTIFY_CEIL = 114
-    if beautify:
-        intensity = int(intensity * BEAUTIFY_CEIL) + 127 - BEAUTIFY_CEIL
-    else:
-        intensity = int(intensity * 127)
-    if rgb is not None:
-        color = int(rgb[0] * 31) << 9 | int(rgb[1] * 31) << 4 | int(rgb[2] * 15)
+    """
+    Set a led intensity from a 0 -> 1 control value through an intensity table (see controls.intensity_lut),
+    and its color when given as a packed value (see LedColor.packed).
+    Deferred leds are only marked dirty and sent by the next flush_leds.
+    """
+    intensity = led_level(value, lut)
+    if defer:
+        key = (channel, cc)
+        if color is None:
+            # Keep a color that is still waiting to be sent
+            color = led_dirty.get(key, (0, None))[1]
+        led_dirty[key] = (intensity, color)
     else:
-        color = None
-    send_cmd(channel, cc, intensity, color)
+        send_cmd(channel, cc, intensity, color)
+
+def led_level(value: float, lut: tuple[int, ...] = intensity_lut()) -> int:
+    """Led intensity of a 0 -> 1 control value through an intensity table."""
+    q = int(value * INTENSITY_MAX + 0.5)
+    return lut[0 if q < 0 else INTENSITY_MAX if q > INTENSITY_MAX else q]
+
+LED_FRAME_RATE = 60  # Max led feedback flushes per second
+led_dirty = {}  # (layer, cc) -> latest (intensity, color) not sent yet
+last_led_flush = 0.0
+def flush_leds():
+    """Send the latest state of every dirty led, at most LED_FRAME_RATE times per second."""
+    global last_led_flush
+    if not led_dirty:
+        return
+    now = monotonic()
+    if now < last_led_flush + 1 / LED_FRAME_RATE:
+        return
+    last_led_flush = now
+    for (layer, cc), (intensity, color) in led_dirty.items():
+        send_cmd(layer, cc, intensity, color)
+    led_dirty.clear()
 
 
+# Shadow of what the hardware currently shows, per layer and cc (None = unknown)
+led_intensity = ([None] * 128, [None] * 128)
+led_color = ([None] * 128, [None] * 128)
+
+def invalidate_leds():
+    """
+    Forget the known hardware LED state and restart the background sync, so that every LED gets sent again
+    (can be called from the script console, e.g. after the grid was reconnected).
+    """
+    for layer in range(2):
+        for cc in range(128):
+            led_intensity[layer][cc] = None
+            led_color[layer][cc] = None
+    # The palette may be gone as well
+    for index in range(PALETTE_SIZE):
+        grid_palette[index] = None
+    if PALETTE_LEDS:
+        upload_palette(control_table)
+    invalidate_sync()
+
+PALETTE_LEDS = False  # Send led colors as palette indexes along with the intensity, needs the palette support of grid_script.lua
+PALETTE_SIZE = 16  # Palette entries on the grid, the index is sent as the midi channel
+palette_index = {}  # Packed color -> palette index on the grid, for the focused plugin
+grid_palette = [None] * PALETTE_SIZE  # 8-bit (r, g, b) of each palette entry uploaded to the grid
+palette_pending = []  # (index, (r, g, b), packed color) to upload when the output budget allows
+
+def build_palette(table: list[Control]) -> list[LedColor]:
+    """The colors of a plugin control table, most used first, at most PALETTE_SIZE."""
+    counts = {}
+    colors = {}
+    for cc in SYNC_CCS:
+        for led in (table[cc].button_led, table[cc].encoder_led):
+            counts[led.packed] = counts.get(led.packed, 0) + 1
+            colors.setdefault(led.packed, led)
+    return [colors[packed] for packed in sorted(counts, key=counts.get, reverse=True)[:PALETTE_SIZE]]
+
+def upload_palette(table: list[Control]):
+    """
+    Upload the palette of a plugin, only the entries that are not on the grid yet.
+    One message per color component: cc on channel 10, 4-bit index, 2-bit component and 8-bit value
+    packed as `param1=index << 3 | component << 1 | value >> 7` and `param2=value & 0x7F`.
+    Entries are sent within the output budget (see drain_palette), until then their color uses color messages.
+    """
+    wanted = [(led.packed, (round(led.r * 255), round(led.g * 255), round(led.b * 255))) for led in build_palette(table)]
+    # Keep the colors that are already on the grid where they are
+    uploaded = {rgb: index for index, rgb in enumerate(grid_palette) if rgb is not None}
+    kept = {uploaded[rgb] for _, rgb in wanted if rgb in uploaded}
+    free = (index for index in range(PALETTE_SIZE) if index not in kept)
+    palette_index.clear()
+    palette_pending.clear()
+    for packed, rgb in wanted:
+        index = uploaded.get(rgb)
+        if index is None:
+            index = next(free)
+            # Overwritten, its previous color is not available anymore
+            grid_palette[index] = None
+            palette_pending.append((index, rgb, packed))
+        else:
+            palette_index[packed] = index
+    drain_palette()
+
+def drain_palette():
+    """Upload the pending palette entries that fit in the output budget."""
+    # An entry costs three messages; with a smaller burst wait for a full bucket
+    while palette_pending and refill_tokens() >= min(3, output_limit[1]):
+        index, rgb, packed = palette_pending.pop(0)
+        for component, value in enumerate(rgb):
+            midi_out(0xB << 4, 10, index << 3 | component << 1 | value >> 7, value & 0x7F)
+        grid_palette[index] = rgb
+        palette_index[packed] = index
+
+def reset_modules_intensity(ccs: range):
+    """Batch clear the led intensity of every module covering the given cc's."""
+    for cc in range(ccs.start, ccs.stop, 16):
+        midi_out(0xB << 4, 2, cc, 0)
+    # The modules clear all their 16 leds on both layers
+    for cc in range(ccs.start - ccs.start % 16, min(128, ccs.stop - ccs.stop % 16 + 16)):
+        led_intensity[0][cc] = 0
+        led_intensity[1][cc] = 0
+        # Queued states are outdated
+        out_queue.pop((1, cc), None)
+        out_queue.pop((2, cc), None)
+
+# Output budget per port as (messages per second, burst), to avoid midi rx overflows on the controller
+OUTPUT_LIMITS = {13: (1000, 64)}
+DEFAULT_OUTPUT_LIMIT = (1000, 64)
+output_limit = None  # Budget of the script port, resolved on first use
+out_tokens = 0.0  # Messages that can be sent right away, negative when in debt
+out_refill_time = 0.0  # Time of the last token refill
+out_queue = {}  # (layer, cc) -> latest (intensity, color) over budget, oldest first
+
+def refill_tokens() -> float:
+    """Add the tokens earned since the last refill, returns the available tokens."""
+    global output_limit, out_tokens, out_refill_time
+    if output_limit is None:
+        output_limit = OUTPUT_LIMITS.get(device.getPortNumber(), DEFAULT_OUTPUT_LIMIT)
+    rate, burst = output_limit
+    now = monotonic()
+    out_tokens = min(burst, out_tokens + (now - out_refill_time) * rate)
+    out_refill_time = now
+    return out_tokens
+
+def midi_out(status: int, channel: int, data1: int, data2: int):
+    """Send a midi message to the controller, it is taken from the output budget even when over it."""
+    global midi_out_count, out_tokens, dual_module
+    device.midiOutMsg(status, channel, data1, data2)
+    midi_out_count += 1
+    out_tokens -= 1
+    # Follow the module that keeps a last cc in grid_script.lua (the target of dual layer messages)
+    if status == 0xB << 4:
+        if channel == 10 or (channel == 2 and dual_module != data1 >> 4):
+            dual_module = None
+        elif channel % 2 == 0 and channel != 2:
+            dual_module = data1 >> 4
+    elif status == 0x9 << 4 or status == 0xA << 4:
+        dual_module = data1 >> 4
+    if trace is not None:
+        trace.record(midi_trace.OUT, status | channel, data1, data2, device.getPortNumber())
+
+def drain_output():
+    """Send the queued led states that fit in the output budget, oldest first."""
+    if not out_queue:
+        return
+    tokens = refill_tokens()
+    burst = output_limit[1]
+    while out_queue:
+        layer, cc = key = next(iter(out_queue))
+        intensity, color = out_queue[key]
+        size = cmd_size(layer, cc, intensity, color)
+        # Commands costing more than the burst wait for a full bucket
+        if min(size, burst) > tokens:
+            return
+        del out_queue[key]
+        emit_cmd(layer, cc, intensity, color)
+        tokens -= size
+
+def cmd_size(layer: int, cc: int, intensity: int, color: Optional[int]) -> int:
+    """Number of messages needed to show a led state (0 when the hardware already shows it)."""
+    buf = 0 if layer == 1 else 1
+    if color is not None and led_color[buf][cc] != color:
+        return 1 if color in palette_index and (intensity or layer == 2) else 2
+    # Color applies to the last intensity cc, so intensity is sent along with any color change
+    return 1 if led_intensity[buf][cc] != intensity else 0
+
 def send_cmd(layer: int, cc: int, intensity: int, color: Optional[int]):
-    """Send a low-level protocol message."""
+    """
+    Send a low-level protocol message, only if it changes what the hardware shows.
+    Over the output budget, the led state is queued instead, replacing any older state of that led.
+    """
+    key = (layer, cc)
+    queued = out_queue.get(key)
+    if queued is not None and color is None:
+        # Keep a color that was not sent yet
+        color = queued[1]
+    size = cmd_size(layer, cc, intensity, color)
+    if size == 0:
+        if queued is not None:
+            del out_queue[key]
+        return
+    if queued is not None or out_queue or refill_tokens() < min(size, output_limit[1]):
+        out_queue[key] = (intensity, color)
+        return
+    emit_cmd(layer, cc, intensity, color)
+
+DUAL_LAYER = False  # Update both led layers of a cc in one message when possible, needs the dual layer support of grid_script.lua
+dual_module = None  # Module (cc >> 4) whose grid script applies dual layer messages, None when no module does
+
+def send_dual(cc: int, intensity1: int, color1: Optional[int], intensity2: int, color2: Optional[int]):
+    """
+    Set both led layers of a cc. On the module that received the last intensity message, both intensities
+    can be sent in one message: `type=0xE0 (pitch bend) | channel=cc % 16 | param1=layer 1 intensity |
+    param2=layer 2 intensity`, followed by the color messages of the layers whose color changed.
+    It is used when it takes fewer messages than one update per layer.
+    """
+    if DUAL_LAYER and dual_module == cc >> 4 and not out_queue:
+        color1_changed = color1 is not None and led_color[0][cc] != color1
+        color2_changed = color2 is not None and led_color[1][cc] != color2
+        size = 1 + color1_changed + color2_changed
+        if size < cmd_size(1, cc, intensity1, color1) + cmd_size(2, cc, intensity2, color2) \
+                and refill_tokens() >= size:
+            midi_out(0xE << 4, cc % 16, intensity1, intensity2)
+            led_intensity[0][cc] = intensity1
+            led_intensity[1][cc] = intensity2
+            # Colors apply to the last cc, which is now this one
+            if color1_changed:
+                midi_out(0xB << 4, 7, color1 >> 7, color1 & 0x7F)
+                led_color[0][cc] = color1
+            if color2_changed:
+                midi_out(0xB << 4, 9, color2 >> 7, color2 & 0x7F)
+                led_color[1][cc] = color2
+            return
+    send_cmd(1, cc, intensity1, color1)
+    send_cmd(2, cc, intensity2, color2)
+
+def emit_cmd(layer: int, cc: int, intensity: int, color: Optional[int]):
+    buf = 0 if layer == 1 else 1
+    color_changed = color is not None and led_color[buf][cc] != color
+    index = palette_index.get(color) if color_changed else None
+    # A note on with intensity 0 is taken as a note off by many midi stacks, it is sent as color messages
+    if index is not None and (intensity or layer == 2):
+        # Intensity and palette color in one message: note on (layer 1) or poly aftertouch (layer 2)
+        midi_out(0x9 << 4 if layer == 1 else 0xA << 4, index, cc, intensity)
+        led_intensity[buf][cc] = intensity
+        led_color[buf][cc] = color
+        return
     # Intensity
-    device.midiOutMsg(0xB << 4, 6 if layer == 1 else 8, cc, intensity)
+    midi_out(0xB << 4, 6 if layer == 1 else 8, cc, intensity)
+    led_intensity[buf][cc] = intensity
     # Color
-    if color is not None:
-        device.midiOutMsg(0xB << 4, 7 if layer == 1 else 9, color >> 7, color & 0x7F)
+    if color_changed:
+        midi_out(0xB << 4, 7 if layer == 1 else 9, color >> 7, color & 0x7F)
+        led_color[buf][cc] = color
 
+if INSTRUMENT:
+    start_instrumentation()
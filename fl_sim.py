@@ -0,0 +1,343 @@
+"""
+FL Modular Grid - Control Intech or any other midi devices
+Copyright (C) 2024-2025  Tom Simonart
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Headless FL Studio simulator, runs device_Intech.py without FL Studio.
+#
+# Fake `device`, `ui`, `mixer`, `general`, `midi`, `transport`, `channels`, `patterns`, `playlist` and
+# `plugins` modules are installed in sys.modules before the script is imported. The focused plugin is a
+# VirtualPlugin with parameters linked to controller cc's. The driver feeds the script callbacks with
+# midi message streams on a virtual clock (or in real time) and records their latency.
+#
+# Usage:
+#   sim = Simulator(VirtualPlugin.from_mapping("Pro-Q 3"))
+#   sim.focus()
+#   sim.run(encoder_sweep(cc=45, detents=200, rate=500))
+#   sim.latencies["OnMidiIn"], sim.midi_out, sim.calls
+
+import sys
+import time
+import types
+from collections import Counter
+from time import perf_counter
+from typing import Iterable, Optional
+
+SCRIPT = "device_Intech"
+FL_MODULES = ("device", "ui", "mixer", "general", "midi", "transport", "channels", "patterns", "playlist", "plugins")
+IDLE_INTERVAL = 0.02  # Time between two OnIdle calls in FL Studio (s)
+START_TIME = 100.0  # Virtual clock start, far enough from 0 for the rate limits of the script
+PORT = 13
+
+# midi module constants used by the script, the values only need to be consistent within the simulator
+MIDI_CONSTANTS = {
+    "FromMIDI_Max": 1 << 30,
+    "REC_MIDIController": 0x20000,
+    "REC_InvalidID": 0x7FFFFFFF,
+    "HW_Dirty_RemoteLinks": 16,
+    "HW_Dirty_FocusedWindow": 32,
+    "HW_Dirty_LEDs": 256,
+    "HW_Dirty_RemoteLinkValues": 512,
+    "FPT_F12": 71,
+    "FPT_MixerWindowJog": 99,
+    "PME_System": 2,
+}
+
+# A message of a stream: (time (s), status, data1, data2)
+Event = tuple[float, int, int, int]
+
+
+class MidiMsg:
+    """Minimal stand-in for fl_classes.FlMidiMsg."""
+    __slots__ = ('status', 'data1', 'data2', 'port', 'handled')
+
+    def __init__(self, status: int, data1: int, data2: int, port: int = PORT):
+        self.status = status
+        self.data1 = data1
+        self.data2 = data2
+        self.port = port
+        self.handled = False
+
+    @property
+    def controlNum(self) -> int:
+        return self.data1
+
+    @property
+    def controlVal(self) -> int:
+        return self.data2
+
+    @property
+    def midiChan(self) -> int:
+        return self.status & 0xF
+
+
+def encode_remote_control_id(port: int, channel: int, cc: int) -> int:
+    return cc + (channel << 16) + ((port + 1) << 22)
+
+
+def decode_cc(control_id: int) -> int:
+    return control_id & 0xFFFF
+
+
+class VirtualPlugin:
+    """A plugin whose parameters are linked to controller cc's (channel 1 = buttons, 2 = encoders)."""
+
+    def __init__(self, name: str = "Virtual Plugin", form_id: int = 5):
+        self.name = name
+        self.form_id = form_id
+        self.links = {}  # Remote control id -> event id
+        self.values = {}  # Event id -> 0 -> 1 parameter value
+        self.names = {}  # Event id -> parameter name
+
+    def link(self, channel: int, cc: int, value: float = 0.0, name: Optional[str] = None, port: int = PORT) -> int:
+        """Link a new parameter to a cc, returns its event id."""
+        event_id = 0x1000 + len(self.values)
+        self.links[encode_remote_control_id(port, channel, cc)] = event_id
+        self.values[event_id] = value
+        self.names[event_id] = name or f"Param {len(self.values)}"
+        return event_id
+
+    @classmethod
+    def from_mapping(cls, name: str, ccs: Iterable[int] = None, value: float = 0.5) -> 'VirtualPlugin':
+        """
+        A plugin linked like a mapped plugin: a button and an encoder parameter on each cc,
+        by default every cc assigned in the mapping of the plugin.
+        """
+        plugin = cls(name)
+        if ccs is None:
+            import mapping_cache
+            from controls import DEFAULT_CONTROL
+            table = mapping_cache.MappingRegistry().get(name) or ()
+            ccs = [cc for cc, control in enumerate(table) if control is not DEFAULT_CONTROL]
+        for cc in ccs:
+            plugin.link(1, cc, value, f"Button {cc}")
+            plugin.link(2, cc, value, f"Encoder {cc}")
+        return plugin
+
+
+class Simulator:
+    """Fake FL Studio API state, and driver of the script callbacks."""
+
+    def __init__(self, plugin: Optional[VirtualPlugin] = None, realtime: bool = False, port: int = PORT):
+        self.plugin = plugin or VirtualPlugin()
+        self.realtime = realtime
+        self.port = port
+        self.now = START_TIME
+        self.midi_out = []  # (status, data1, data2) sent to the controller
+        self.sysex_out = []  # Sysex messages sent to the controller
+        self.hint = ""
+        self.calls = Counter()  # FL API function -> number of calls
+        self.latencies = {"OnMidiIn": [], "OnIdle": [], "OnRefresh": []}  # Callback -> durations (s)
+        self.next_idle = self.now
+        self.values_dirty = False  # A linked value changed since the last OnRefresh
+        self.modules = self.build_modules()
+        self.script = None
+        self.load_script()
+
+    # Fake FL Studio API
+
+    def build_modules(self) -> dict[str, types.ModuleType]:
+        midi = {
+            **MIDI_CONSTANTS,
+            "EncodeRemoteControlID": encode_remote_control_id,
+        }
+        device = {
+            "getPortNumber": lambda: self.port,
+            "findEventID": lambda control_id, flags=0: self.plugin.links.get(control_id, MIDI_CONSTANTS["REC_InvalidID"]),
+            "getLinkedInfo": lambda event_id: 0 if event_id in self.plugin.values else -1,
+            "getLinkedValue": lambda event_id: self.plugin.values.get(event_id, 0.0),
+            "getLinkedParamName": lambda event_id: self.plugin.names.get(event_id, ""),
+            "getLinkedValueString": lambda event_id: f"{round(self.plugin.values.get(event_id, 0.0) * 100)}%",
+            "midiOutMsg": self.midi_out_msg,
+            "midiOutSysex": self.sysex_out.append,
+        }
+        general = {
+            "processRECEvent": self.process_rec_event,
+        }
+        mixer = {
+            "automateEvent": self.automate_event,
+        }
+        ui = {
+            "getFocusedPluginName": lambda: self.plugin.name,
+            "getFocusedFormID": lambda: self.plugin.form_id,
+            "getFocused": lambda index: self.plugin.form_id == index,
+            "setHintMsg": self.set_hint_msg,
+        }
+        channels = {
+            "selectedChannel": lambda *args: 0,
+        }
+        patterns = {
+            "patternNumber": lambda: 1,
+            "isPatternDefault": lambda index: True,
+        }
+        api = {"device": device, "general": general, "mixer": mixer, "ui": ui, "channels": channels, "patterns": patterns}
+        modules = {}
+        for name in FL_MODULES:
+            module = types.ModuleType(name)
+            for attr, value in midi.items() if name == "midi" else api.get(name, {}).items():
+                setattr(module, attr, self.counted(f"{name}.{attr}", value) if callable(value) else value)
+            # Every other function does nothing
+            module.__getattr__ = self.noop_factory(name)
+            modules[name] = module
+        return modules
+
+    def counted(self, name: str, func):
+        calls = self.calls
+
+        def wrapper(*args, **kwargs):
+            calls[name] += 1
+            return func(*args, **kwargs)
+        return wrapper
+
+    def noop_factory(self, module: str):
+        def getattr_(attr: str):
+            if attr.startswith("__"):
+                raise AttributeError(attr)
+            return self.counted(f"{module}.{attr}", lambda *args, **kwargs: 0)
+        return getattr_
+
+    def midi_out_msg(self, status: int, channel: int = 0, data1: int = 0, data2: int = 0):
+        self.midi_out.append((status | channel, data1, data2))
+
+    def process_rec_event(self, event_id: int, value: int, flags: int) -> int:
+        if event_id in self.plugin.values:
+            self.plugin.values[event_id] = min(max(value / MIDI_CONSTANTS["FromMIDI_Max"], 0.0), 1.0)
+            self.values_dirty = True
+        return value
+
+    def automate_event(self, event_id: int, value: int, flags: int, speed: int = 0, is_increment: int = 0,
+                       res: float = 1 / 128) -> bool:
+        if event_id not in self.plugin.values:
+            return False
+        current = self.plugin.values[event_id]
+        new = current + value * res if is_increment else value / MIDI_CONSTANTS["FromMIDI_Max"]
+        self.plugin.values[event_id] = min(max(new, 0.0), 1.0)
+        self.values_dirty = True
+        return True
+
+    def set_hint_msg(self, text: str):
+        self.hint = text
+
+    # Driver
+
+    def load_script(self):
+        """Import a fresh copy of the script against the fake modules."""
+        sys.modules.update(self.modules)
+        sys.modules.pop(SCRIPT, None)
+        self.script = __import__(SCRIPT)
+        if not self.realtime:
+            self.script.monotonic = self.clock
+            # Traces recorded in the simulator are timed on the same clock
+            import midi_trace
+            midi_trace.monotonic = self.clock
+        return self.script
+
+    def clock(self) -> float:
+        return self.now
+
+    def advance(self, t: float):
+        """
+        Move the clock to time t (s since START_TIME), calling OnIdle on the way like FL Studio does,
+        and OnRefresh before it when linked values changed.
+        """
+        t += START_TIME
+        while self.next_idle <= t:
+            self.wait(self.next_idle)
+            if self.values_dirty:
+                self.refresh(MIDI_CONSTANTS["HW_Dirty_RemoteLinkValues"])
+            self.idle()
+            self.next_idle += IDLE_INTERVAL
+        self.wait(t)
+
+    def elapse(self, dt: float):
+        """Let `dt` seconds pass."""
+        self.advance(self.now - START_TIME + dt)
+
+    def wait(self, t: float):
+        if t <= self.now:
+            return
+        if self.realtime:
+            delay = t - self.now
+            if delay > 0:
+                time.sleep(delay)
+        self.now = t
+
+    def timed(self, callback: str, *args):
+        start = perf_counter()
+        getattr(self.script, callback)(*args)
+        self.latencies[callback].append(perf_counter() - start)
+
+    def idle(self, n: int = 1):
+        for _ in range(n):
+            self.timed("OnIdle")
+
+    def refresh(self, flags: int = MIDI_CONSTANTS["HW_Dirty_FocusedWindow"]):
+        self.values_dirty = False
+        self.timed("OnRefresh", flags)
+
+    def focus(self, plugin: Optional[VirtualPlugin] = None):
+        """Focus a plugin (the current one by default)."""
+        if plugin is not None:
+            self.plugin = plugin
+        self.refresh(MIDI_CONSTANTS["HW_Dirty_FocusedWindow"] | MIDI_CONSTANTS["HW_Dirty_RemoteLinks"])
+
+    def send(self, status: int, data1: int, data2: int) -> MidiMsg:
+        msg = MidiMsg(status, data1, data2, self.port)
+        self.timed("OnMidiIn", msg)
+        return msg
+
+    def run(self, events: Iterable[Event], settle: float = 0.1):
+        """Feed a message stream to the script from the current time, then keep idling for `settle` seconds."""
+        offset = t = self.now - START_TIME
+        for t, status, data1, data2 in events:
+            t += offset
+            self.advance(t)
+            self.send(status, data1, data2)
+        self.advance(t + settle)
+
+    def reset_stats(self):
+        self.midi_out.clear()
+        self.sysex_out.clear()
+        self.calls.clear()
+        for latencies in self.latencies.values():
+            latencies.clear()
+
+
+# Synthetic message streams, times are relative to `start` (s)
+
+def encoder_sweep(cc: int, detents: int, rate: float, speed: int = 1, channel: int = 2, start: float = 0.0):
+    """An encoder turned by `speed` detents per message (negative = counter clockwise), `rate` messages per second."""
+    for i in range(detents):
+        yield (start + i / rate, 0xB0 | channel, cc, 64 + speed)
+
+
+def button_presses(cc: int, count: int, rate: float, channel: int = 1, start: float = 0.0):
+    """A button pressed and released `count` times, `rate` presses per second."""
+    for i in range(count):
+        yield (start + i / rate, 0xB0 | channel, cc, 127)
+        yield (start + (i + 0.5) / rate, 0xB0 | channel, cc, 0)
+
+
+def merge(*streams: Iterable[Event]) -> list[Event]:
+    """Interleave message streams by time."""
+    return sorted((event for stream in streams for event in stream), key=lambda event: event[0])
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
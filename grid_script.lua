@@ -1,17 +1,39 @@
-l = (ch < 8) and 1 or 2
-if ch % 2 == 1 and self.lcc >= 0 then
-    led_color(self.lcc, l, (p1 >> 2) * 255 // 31, (((p1 & 3) << 3) | (p2 >> 4)) * 255 // 31, (p2 & 13) * 255 // 15, 1)
-end
-if ch % 2 == 0 and p1 >= self.ci and p1 <= self.cx then
-    if ch == 2 then
-        for i = 0, 15 do
-            led_value(i, 1, 0)
-            led_value(i, 2, 0)
-        end
-    else
+if cmd == 144 or cmd == 160 then
+    if p1 >= self.ci and p1 <= self.cx then
+        l = (cmd == 144) and 1 or 2
+        i = ch * 3
         self.lcc = p1 % 16
         led_value(self.lcc, l, p2)
+        led_color(self.lcc, l, self.pal[i + 1], self.pal[i + 2], self.pal[i + 3], 1)
+    else
+        self.lcc = -1
     end
-else
+elseif cmd == 224 then
+    if self.lcc >= 0 then
+        self.lcc = ch
+        led_value(ch, 1, p1)
+        led_value(ch, 2, p2)
+    end
+elseif ch == 10 then
+    self.pal[(p1 >> 3) * 3 + ((p1 >> 1) & 3) + 1] = ((p1 & 1) << 7) | p2
     self.lcc = -1
-end
\ No newline at end of file
+else
+    l = (ch < 8) and 1 or 2
+    if ch % 2 == 1 then
+        if self.lcc >= 0 then
+            led_color(self.lcc, l, (p1 >> 2) * 255 // 31, (((p1 & 3) << 3) | (p2 >> 4)) * 255 // 31, (p2 & 15) * 255 // 15, 1)
+        end
+    elseif p1 >= self.ci and p1 <= self.cx then
+        if ch == 2 then
+            for i = 0, 15 do
+                led_value(i, 1, 0)
+                led_value(i, 2, 0)
+            end
+        else
+            self.lcc = p1 % 16
+            led_value(self.lcc, l, p2)
+        end
+    else
+        self.lcc = -1
+    end
+end
@@ -0,0 +1,133 @@
+"""
+FL Modular Grid - Control Intech or any other midi devices
+Copyright (C) 2024-2025  Tom Simonart
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Latency instrumentation.
+#
+# Functions and FL API calls are timed by wrappers that record into fixed-size log-bucket histograms
+# (4 buckets per power of 2, so percentiles are within 25%). Nothing is wrapped until instrument()
+# is called, so the script runs at full speed when instrumentation is off.
+
+from time import perf_counter_ns
+
+SUB_BUCKETS = 4  # Buckets per power of 2 (must be a power of 2)
+SUB_BITS = SUB_BUCKETS.bit_length() - 1
+BUCKETS = 48 * SUB_BUCKETS  # Up to 2^48 ns (~78 hours)
+
+
+class Histogram:
+    """Log-bucket histogram of durations (ns)."""
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, ns: int):
+        n = ns.bit_length()
+        if n <= SUB_BITS + 1:
+            index = ns
+        else:
+            index = ((n - SUB_BITS) << SUB_BITS) + ((ns >> (n - SUB_BITS - 1)) & (SUB_BUCKETS - 1))
+            if index >= BUCKETS:
+                index = BUCKETS - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def reset(self):
+        for i in range(BUCKETS):
+            self.counts[i] = 0
+        self.count = self.total = self.max = 0
+
+    def percentile(self, p: float) -> int:
+        """Upper bound (ns) of the bucket holding the p-th percentile."""
+        target = p / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(bucket_limit(index), self.max)
+        return self.max
+
+
+def bucket_limit(index: int) -> int:
+    """Largest duration (ns) of a bucket."""
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = (index >> SUB_BITS) - 1
+    return ((SUB_BUCKETS + (index & (SUB_BUCKETS - 1)) + 1) << shift) - 1
+
+
+def timed(histogram: Histogram, func):
+    """Wrap a function to record the duration of every call."""
+    record = histogram.record
+
+    def wrapper(*args, **kwargs):
+        start = perf_counter_ns()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(perf_counter_ns() - start)
+    wrapper.__wrapped__ = func
+    wrapper.__name__ = getattr(func, "__name__", "wrapper")
+    return wrapper
+
+
+class TimedModule:
+    """Stand-in for a module, with some of its functions timed."""
+
+    def __init__(self, module, histograms: dict[str, Histogram]):
+        self._module = module
+        for name, histogram in histograms.items():
+            setattr(self, name, timed(histogram, getattr(module, name)))
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+
+def instrument(namespace: dict, functions: tuple[str, ...], api: dict[str, tuple[str, ...]]) -> dict[str, Histogram]:
+    """
+    Time the given functions of a module namespace, and the given functions of the modules it imported
+    (e.g. {"device": ("midiOutMsg",)}). Returns the histograms by name.
+    """
+    histograms = {}
+    for name in functions:
+        histograms[name] = Histogram()
+        namespace[name] = timed(histograms[name], namespace[name])
+    for module, names in api.items():
+        module_histograms = {name: Histogram() for name in names}
+        namespace[module] = TimedModule(namespace[module], module_histograms)
+        histograms.update((f"{module}.{name}", histogram) for name, histogram in module_histograms.items())
+    return histograms
+
+
+def report(histograms: dict[str, Histogram]) -> str:
+    lines = [f"{'':<24} {'calls':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9} {'total':>9}  (us, total in ms)"]
+    for name, histogram in histograms.items():
+        if not histogram.count:
+            continue
+        p50, p95, p99 = (histogram.percentile(p) / 1000 for p in (50, 95, 99))
+        lines.append(
+            f"{name:<24} {histogram.count:>8} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f} "
+            f"{histogram.max / 1000:>9.1f} {histogram.total / 1e6:>9.1f}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+FL Modular Grid - Control Intech or any other midi devices
+Copyright (C) 2024-2025  Tom Simonart
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Mapping linter, runs without FL Studio.
+#
+# Checks every mapping shard against the grid layout and reports all the problems at once:
+# duplicate plugin names or cc's (silently overwritten in a dict literal), cc's outside of the
+# modules, steps < 2, and encoder or button settings on modules that do not have them.
+#
+# Usage: python lint_mapping.py [mapping files...]   (defaults to every mapping shard)
+
+import ast
+import json
+import re
+import sys
+
+import controls
+from controls import GRID_LAYOUT, Control, CtrlButton, CtrlEncoder, LedColor
+from mapping_cache import control_from_json, find_sources
+
+MODULES = {cc: module for module in GRID_LAYOUT for cc in module.ccs}
+DEFAULT_ENCODER = CtrlEncoder()
+DEFAULT_BUTTON = CtrlButton()
+
+
+class Pairs(list):
+    """Json object kept as its list of (key, value) pairs, so duplicate keys are not lost."""
+
+
+def as_dict(value):
+    if isinstance(value, Pairs):
+        return {key: as_dict(item) for key, item in value}
+    return value
+
+
+# Plugins of a python mapping: [(name, line, [(cc, line, control source)] or None when not a dict)]
+PluginEntries = list[tuple[object, int, list[tuple[object, int, str]]]]
+
+START_RE = re.compile(r'(mapping|plugins)\s*=\s*\{\s*(#.*)?$')
+PLUGINS_KEY_RE = re.compile(r'\s*"plugins"\s*:\s*\{\s*(#.*)?$')
+PLUGIN_RE = re.compile(r'\s*"((?:[^"\\]|\\.)*)"\s*:\s*\{\s*(\}\s*,?\s*)?(#.*)?$')
+SKIP_RE = re.compile(r'\s*(#.*)?$')
+
+
+def scan_python(source: str):
+    """
+    Line based reader for the usual mapping layout (one plugin name or control per line),
+    much faster than the python parser. Returns None when the source does not follow that layout.
+    """
+    lines = source.splitlines()
+    i = 0
+    # Find the plugins dict
+    while i < len(lines):
+        match = START_RE.match(lines[i])
+        i += 1
+        if match:
+            break
+    else:
+        return None
+    if match.group(1) == "mapping":
+        while i < len(lines) and SKIP_RE.match(lines[i]):
+            i += 1
+        if i == len(lines) or not PLUGINS_KEY_RE.match(lines[i]):
+            return None
+        i += 1
+    plugins = []
+    controls_ = None
+    for lineno in range(i + 1, len(lines) + 1):
+        line = lines[lineno - 1].strip()
+        if not line or line[0] == "#":
+            continue
+        if line[0] == "}":
+            if line[1:].lstrip(" ,")[:1] not in ("", "#"):
+                return None
+            if controls_ is None:
+                return plugins
+            controls_ = None
+        elif controls_ is not None:
+            # <cc>: <control>,  # comment
+            cc, sep, text = line.partition(":")
+            if not sep or not cc.strip().isdigit() or '"' in text or "'" in text:
+                return None
+            text = text.partition("#")[0].strip().rstrip(",").rstrip()
+            if text.count("(") != text.count(")") or text.count("[") != text.count("]"):
+                return None  # Control spanning several lines
+            controls_.append((int(cc), lineno, text))
+        else:
+            match = PLUGIN_RE.match(line)
+            if not match or "\\" in match.group(1):
+                return None
+            entries = []
+            plugins.append((match.group(1), lineno, entries))
+            if not match.group(2):
+                controls_ = entries
+    return None
+
+
+def parse_python(source: str, path: str):
+    """Read the plugins of a python mapping with the python parser."""
+    tree = ast.parse(source, path)
+    plugins = None
+    for node in tree.body:
+        if not isinstance(node, ast.Assign) or len(node.targets) != 1 or not isinstance(node.targets[0], ast.Name):
+            continue
+        if node.targets[0].id == "plugins" and isinstance(node.value, ast.Dict):
+            plugins = node.value
+        elif node.targets[0].id == "mapping" and isinstance(node.value, ast.Dict):
+            for key, value in zip(node.value.keys, node.value.values):
+                if isinstance(key, ast.Constant) and key.value == "plugins" and isinstance(value, ast.Dict):
+                    plugins = value
+    if plugins is None:
+        return None
+    result = []
+    for key, value in zip(plugins.keys, plugins.values):
+        name = key.value if isinstance(key, ast.Constant) else None
+        if not isinstance(value, ast.Dict):
+            result.append((name, value.lineno, None))
+            continue
+        entries = []
+        for cc_node, control_node in zip(value.keys, value.values):
+            cc = cc_node.value if isinstance(cc_node, ast.Constant) else None
+            entries.append((cc, control_node.lineno, ast.unparse(control_node)))
+        result.append((name, value.lineno, entries))
+    return result
+
+
+class Linter:
+    def __init__(self):
+        self.problems = []
+        self.plugins = {}  # Plugin name -> where it was first declared
+        self.evaluated = {}  # Control source -> Control, or the error message
+        self.checked = {}  # id(Control) -> (Control, problems, uses encoder, uses button)
+
+    def report(self, where: str, message: str):
+        self.problems.append(f"{where}: {message}")
+
+    def lint_file(self, path: str):
+        try:
+            with open(path, encoding="utf-8") as f:
+                source = f.read()
+        except OSError as e:
+            self.report(path, f"cannot read mapping ({e})")
+            return
+        if path.endswith(".json"):
+            self.lint_json(path, source)
+        else:
+            self.lint_python(path, source)
+
+    def lint_json(self, path: str, source: str):
+        try:
+            data = json.loads(source, object_pairs_hook=Pairs)
+        except ValueError as e:
+            self.report(path, f"invalid json ({e})")
+            return
+        plugins = dict(data).get("plugins") if isinstance(data, Pairs) else None
+        if not isinstance(plugins, Pairs):
+            self.report(path, "no `{\"plugins\": {...}}` object found")
+            return
+        for name, plugin in plugins:
+            where = f"{path}: {name}"
+            self.declare_plugin(name, where)
+            if not isinstance(plugin, Pairs):
+                self.report(where, "controls must be an object")
+                continue
+            seen = set()
+            for cc, value in plugin:
+                cc_where = f"{where}: cc {cc}"
+                if not cc.isdigit():
+                    self.report(cc_where, "cc's must be integers")
+                    continue
+                if cc in seen:
+                    self.report(cc_where, "duplicate cc, the previous one is overwritten")
+                seen.add(cc)
+                try:
+                    control = control_from_json(as_dict(value))
+                except Exception as e:
+                    self.report(cc_where, f"invalid control ({type(e).__name__}: {e})")
+                    continue
+                self.check_control(cc_where, int(cc), control)
+
+    def lint_python(self, path: str, source: str):
+        plugins = scan_python(source)
+        if plugins is None:
+            # Unusual layout, use the (slower) python parser
+            try:
+                plugins = parse_python(source, path)
+            except SyntaxError as e:
+                self.report(f"{path}:{e.lineno}", f"syntax error ({e.msg})")
+                return
+        if plugins is None:
+            self.report(path, "no `mapping = {\"plugins\": {...}}` or `plugins = {...}` dict literal found")
+            return
+        for name, lineno, controls_ in plugins:
+            where = f"{path}:{lineno}"
+            if not isinstance(name, str):
+                self.report(where, "plugin names must be string literals")
+                continue
+            self.declare_plugin(name, where)
+            if controls_ is None:
+                self.report(where, f"{name}: controls must be a dict literal")
+                continue
+            seen = set()
+            for cc, cc_lineno, text in controls_:
+                cc_where = f"{path}:{cc_lineno}"
+                if not isinstance(cc, int):
+                    self.report(cc_where, f"{name}: cc's must be integer literals")
+                    continue
+                if cc in seen:
+                    self.report(cc_where, f"{name}: duplicate cc {cc}, the previous one is overwritten")
+                seen.add(cc)
+                control = self.evaluate(text)
+                if isinstance(control, str):
+                    self.report(cc_where, f"{name}: cc {cc}: {control}")
+                    continue
+                self.check_control(f"{cc_where}: {name}: cc {cc}", cc, control)
+
+    def evaluate(self, text: str):
+        """Evaluate a control expression, identical expressions are only evaluated once."""
+        control = self.evaluated.get(text)
+        if control is None:
+            try:
+                control = eval(text, vars(controls))
+                if not isinstance(control, Control):
+                    control = f"expected a Control, got {type(control).__name__}"
+            except Exception as e:
+                control = f"invalid control ({type(e).__name__}: {e})"
+            self.evaluated[text] = control
+        return control
+
+    def declare_plugin(self, name: str, where: str):
+        if name in self.plugins:
+            self.report(where, f"duplicate plugin {name!r}, also declared at {self.plugins[name]}")
+        else:
+            self.plugins[name] = where
+
+    def check_control(self, where: str, cc, control: Control):
+        # Checks not depending on the cc are done once per control object
+        entry = self.checked.get(id(control))
+        if entry is None or entry[0] is not control:
+            problems = []
+            if control.encoder.steps < 2:
+                problems.append(f"encoder steps must be >= 2, got {control.encoder.steps}")
+            if control.button.steps < 2:
+                problems.append(f"button steps must be >= 2, got {control.button.steps}")
+            uses_encoder = control.encoder_led != LedColor.off() or control.encoder != DEFAULT_ENCODER
+            uses_button = control.button_led != LedColor.off() or control.button != DEFAULT_BUTTON
+            entry = (control, problems, uses_encoder, uses_button)
+            self.checked[id(control)] = entry
+        _, problems, uses_encoder, uses_button = entry
+        module = MODULES.get(cc)
+        if module is None:
+            self.report(where, "cc is not on any module of the grid layout")
+        else:
+            if uses_encoder and not module.encoders:
+                self.report(where, "encoder settings on a module without encoders")
+            if uses_button and not module.buttons:
+                self.report(where, "button settings on a module without buttons")
+        for problem in problems:
+            self.report(where, problem)
+
+
+def main(paths: list[str]) -> int:
+    linter = Linter()
+    for path in paths or find_sources():
+        linter.lint_file(path)
+    for problem in linter.problems:
+        print(problem)
+    if linter.problems:
+        print(f"{len(linter.problems)} problem(s) found")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
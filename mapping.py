@@ -15,120 +15,7 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-from dataclasses import dataclass, field
-from enum import Enum, auto
-
-
-@dataclass
-class LedColor:
-    r: float = 0
-    g: float = 0
-    b: float = 0
-
-    @property
-    def rgb(self):
-        return self.r, self.g, self.b
-
-    def __str__(self):
-        return f"({self.r}, {self.g}, {self.b})"
-    
-    @classmethod
-    def off(cls):
-        return cls(0, 0, 0)
-    
-    @classmethod
-    def default_button(cls):
-        return cls(1, 0, 0)
-    
-    @classmethod
-    def default_encoder(cls):
-        return cls(0, 0, 1)
-    
-    @classmethod
-    def white(cls):
-        return cls(1, 1, 1)
-    
-    @classmethod
-    def grey(cls):
-        return cls(0.5, 0.5, 0.5)
-
-    @classmethod
-    def red(cls):
-        return cls(1, 0, 0)
-
-    @classmethod
-    def green(cls):
-        return cls(0, 1, 0)
-    
-    @classmethod
-    def blue(cls):
-        return cls(0, 0, 1)
-    
-    @classmethod
-    def yellow(cls):
-        return cls(1, 1, 0)
-    
-    @classmethod
-    def cyan(cls):
-        return cls(0, 1, 1)
-    
-    @classmethod
-    def magenta(cls):
-        return cls(1, 0, 1)
-    
-    @classmethod
-    def orange(cls):
-        return cls(1, 0.5, 0)
-    
-    @classmethod
-    def purple(cls):
-        return cls(0.5, 0, 1)
-    
-    @classmethod
-    def pink(cls):
-        return cls(1, 0, 0.5)
-    
-    @classmethod
-    def teal(cls):
-        return cls(0, 1, 0.5)
-    
-    @classmethod
-    def lime(cls):
-        return cls(0.5, 1, 0)
-    
-    @classmethod
-    def azure(cls):
-        return cls(0, 0.5, 1)
-    
-    @classmethod
-    def brown(cls):
-        return cls(0.5, 0.25, 0)
-    
-    @classmethod
-    def lightgreen(cls):
-        return cls(0.5, 1, 0.5)
-
-
-@dataclass
-class CtrlEncoder():
-    steps: int = 255
-    accel: bool = True
-    invert: bool = False
-    invert_intensity: bool = False
-
-@dataclass
-class CtrlButton():
-    steps: int = 2
-    invert_intensity: bool = False
-
-@dataclass
-class Control:
-    button_led: LedColor = field(default_factory=LedColor.off)
-    encoder_led: LedColor = field(default_factory=LedColor.off)
-    beautify_button: bool = True
-    beautify_encoder: bool = True
-    encoder: CtrlEncoder = field(default_factory=CtrlEncoder)
-    button: CtrlButton = field(default_factory=CtrlButton)
+from controls import AccelCurve, Control, CtrlButton, CtrlEncoder, Curve, LedColor
 
 mapping = {
     "plugins": {
@@ -0,0 +1,341 @@
+"""
+FL Modular Grid - Control Intech or any other midi devices
+Copyright (C) 2024-2025  Tom Simonart
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Compiled mapping cache.
+#
+# Mapping shards (`mapping.json` when present or `mapping.py`, plus every file of `mappings/`) are each
+# compiled into a compact binary file: a pool of unique control records and one 128-slot array of
+# pool indexes per plugin. An index file keeps the plugin names of every shard, so loading never
+# executes a mapping source, a shard is only recompiled when it changes (size / mtime, then content hash)
+# or when controls.py changes.
+#
+# Usage: python mapping_cache.py [--export mapping.json]
+
+import importlib
+import importlib.util
+import json
+import marshal
+import os
+import sys
+from array import array
+from collections import OrderedDict
+from dataclasses import fields, is_dataclass
+from enum import Enum
+from hashlib import sha1
+
+import controls
+from controls import CONTROL_SLOTS, DEFAULT_CONTROL, Control, LedColor, interned
+
+CACHE_FORMAT = 2
+
+
+def schema_version() -> str:
+    """
+    Version of the cache files: the cache format and a hash of controls.py. Records hold every init field
+    of the mapping classes by position, defaults included, so any change to them recompiles the mapping.
+    """
+    with open(controls.__file__, "rb") as f:
+        return f"{CACHE_FORMAT}-{sha1(f.read()).hexdigest()[:16]}"
+
+
+CACHE_VERSION = schema_version()
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(BASE_DIR, ".mapping_cache")
+INDEX_PATH = os.path.join(CACHE_DIR, "index")
+JSON_SOURCE = os.path.join(BASE_DIR, "mapping.json")
+PY_SOURCE = os.path.join(BASE_DIR, "mapping.py")
+SHARDS_DIR = os.path.join(BASE_DIR, "mappings")  # One mapping file per vendor or plugin
+LRU_SIZE = 16  # Max number of plugin control tables kept loaded
+
+
+def encode(obj):
+    """Encode a mapping dataclass as nested tuples of its init fields."""
+    values = []
+    for f in fields(obj):
+        if not f.init:
+            continue
+        value = getattr(obj, f.name)
+        if is_dataclass(value):
+            value = encode(value)
+        elif isinstance(value, Enum):
+            value = value.name
+        values.append(value)
+    return tuple(values)
+
+
+def decode(cls, record):
+    """Build a mapping dataclass back from its encoded record."""
+    kwargs = {}
+    init_fields = [f for f in fields(cls) if f.init]
+    for f, value in zip(init_fields, record):
+        if is_dataclass(f.type):
+            value = decode(f.type, value)
+        elif isinstance(f.type, type) and issubclass(f.type, Enum):
+            value = f.type[value]
+        kwargs[f.name] = value
+    return cls(**kwargs)
+
+
+def compile_mapping(plugins: dict[str, dict[int, Control]]) -> tuple[list[tuple], dict[str, bytes]]:
+    """Compile plugin mappings into a pool of unique control records and per plugin slot arrays."""
+    pool = [encode(DEFAULT_CONTROL)]
+    indexes = {pool[0]: 0}
+    tables = {}
+    for name, controls in plugins.items():
+        slots = array('H', bytes(2 * CONTROL_SLOTS))
+        for cc, control in controls.items():
+            record = encode(control)
+            index = indexes.get(record)
+            if index is None:
+                index = indexes[record] = len(pool)
+                pool.append(record)
+            slots[cc] = index
+        tables[name] = slots.tobytes()
+    return pool, tables
+
+
+def find_sources() -> list[str]:
+    """Returns every mapping shard: the main mapping source, then the files of the mappings directory."""
+    sources = [JSON_SOURCE if os.path.exists(JSON_SOURCE) else PY_SOURCE]
+    if os.path.isdir(SHARDS_DIR):
+        sources += sorted(
+            os.path.join(SHARDS_DIR, name) for name in os.listdir(SHARDS_DIR)
+            if name.endswith((".json", ".py")) and not name.startswith("_")
+        )
+    return sources
+
+
+def read_source(path: str) -> dict[str, dict[int, Control]]:
+    """Load plugin mappings from a json or python mapping source."""
+    if path.endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return {
+            name: {int(cc): control_from_json(control) for cc, control in controls.items()}
+            for name, controls in data["plugins"].items()
+        }
+    if path == PY_SOURCE:
+        if "mapping" in sys.modules:
+            module = importlib.reload(sys.modules["mapping"])
+        else:
+            module = importlib.import_module("mapping")
+        return module.mapping["plugins"]
+    # Python shards declare a `plugins` dict
+    spec = importlib.util.spec_from_file_location("_mapping_shard", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.plugins
+
+
+def shard_cache_path(path: str) -> str:
+    name = os.path.relpath(path, BASE_DIR).replace(os.sep, "_")
+    return os.path.join(CACHE_DIR, name + ".cache")
+
+
+def load_cache(path: str):
+    try:
+        with open(path, "rb") as f:
+            return marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def write_cache(data, path: str):
+    """Write a cache file atomically, the scripts directory may be read only in which case it is skipped."""
+    tmp_path = path + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            marshal.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+class MappingRegistry:
+    """
+    Index of the plugin names of every mapping shard.
+    A plugin control table is only loaded from its shard cache the first time it is requested,
+    and kept in a bounded LRU.
+    """
+
+    def __init__(self, sources: list[str] = None, capacity: int = LRU_SIZE):
+        self.sources = sources
+        self.capacity = capacity
+        self.index = {}  # Plugin name -> shard source path
+        self.stamps = {}  # Shard source path -> (version, mtime, size, hash, plugin names)
+        self.tables = OrderedDict()  # Plugin name -> control table, least recently used first
+        self.errors = {}  # Shard source path -> (mtime, size, error message) of a shard that failed to load
+        self.refresh()
+
+    def refresh(self) -> set[str]:
+        """
+        Recompile the shards that changed since the last refresh. Returns the names of their plugins.
+        A shard that fails to load (e.g. saved while being edited) keeps its previous version,
+        the error is kept in `errors` until the shard changes again.
+        """
+        sources = self.sources or find_sources()
+        stamps = self.stamps or load_cache(INDEX_PATH)
+        if not isinstance(stamps, dict):
+            stamps = {}
+        changed = set()
+        dirty = False
+        for path in sources:
+            stamp = stamps.get(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # Removed since the sources were listed
+            if stamp is not None and stamp[0] == CACHE_VERSION and stamp[1:3] == (stat.st_mtime_ns, stat.st_size):
+                continue
+            error = self.errors.pop(path, None)
+            if error is not None and error[:2] == (stat.st_mtime_ns, stat.st_size):
+                self.errors[path] = error
+                continue
+            with open(path, "rb") as f:
+                digest = sha1(f.read()).hexdigest()
+            if stamp is None or stamp[0] != CACHE_VERSION or stamp[3] != digest \
+                    or not os.path.exists(shard_cache_path(path)):
+                try:
+                    pool, tables = compile_mapping(read_source(path))
+                except Exception as e:
+                    self.errors[path] = (stat.st_mtime_ns, stat.st_size, f"{type(e).__name__}: {e}")
+                    continue
+                write_cache({"pool": pool, "plugins": tables}, shard_cache_path(path))
+                names = tuple(tables)
+                changed.update(names)
+                if stamp is not None:
+                    changed.update(stamp[4])
+            else:
+                names = stamp[4]
+            stamps[path] = (CACHE_VERSION, stat.st_mtime_ns, stat.st_size, digest, names)
+            dirty = True
+        for path in set(stamps) - set(sources):
+            changed.update(stamps.pop(path)[4])
+            dirty = True
+        if dirty:
+            write_cache(stamps, INDEX_PATH)
+        self.stamps = stamps
+        self.index = {name: path for path in sources if path in stamps for name in stamps[path][4]}
+        for name in changed:
+            self.tables.pop(name, None)
+        return changed
+
+    def __contains__(self, plugin: str) -> bool:
+        return plugin in self.index
+
+    def get(self, plugin: str):
+        """Returns the control table of a plugin, or None when the plugin is not mapped."""
+        table = self.tables.get(plugin)
+        if table is not None:
+            self.tables.move_to_end(plugin)
+            return table
+        path = self.index.get(plugin)
+        if path is None:
+            return None
+        cache = load_cache(shard_cache_path(path))
+        if cache is None or plugin not in cache["plugins"]:
+            # Cache removed behind our back
+            pool, tables = compile_mapping(read_source(path))
+            cache = {"pool": pool, "plugins": tables}
+            write_cache(cache, shard_cache_path(path))
+        slots = array('H')
+        slots.frombytes(cache["plugins"][plugin])
+        controls = {0: DEFAULT_CONTROL}
+        table = []
+        for index in slots:
+            control = controls.get(index)
+            if control is None:
+                control = controls[index] = interned(decode(Control, cache["pool"][index]))
+            table.append(control)
+        self.tables[plugin] = table
+        if len(self.tables) > self.capacity:
+            self.tables.popitem(last=False)
+        return table
+
+
+def control_from_json(data: dict) -> Control:
+    """
+    Build a Control from its json form, colors are either a LedColor preset name ("blue") or [r, g, b].
+    Example: {"encoder_led": "blue", "button_led": [1, 0, 0.5], "encoder": {"steps": 5, "accel": false}}
+    """
+    kwargs = dict(data)
+    for key in ("button_led", "encoder_led"):
+        if key in kwargs:
+            value = kwargs[key]
+            kwargs[key] = getattr(LedColor, value)() if isinstance(value, str) else LedColor(*value)
+    template = Control()
+    for key in ("encoder", "button"):
+        if key in kwargs:
+            kwargs[key] = decode_partial(type(getattr(template, key)), kwargs[key])
+    return Control(**kwargs)
+
+
+def decode_partial(cls, data: dict):
+    """Build a dataclass from a json object holding only the fields that differ from the defaults."""
+    kwargs = {}
+    for f in fields(cls):
+        if f.name not in data:
+            continue
+        value = data[f.name]
+        if is_dataclass(f.type):
+            value = decode_partial(f.type, value)
+        elif isinstance(f.type, type) and issubclass(f.type, Enum):
+            value = f.type[value]
+        kwargs[f.name] = value
+    return cls(**kwargs)
+
+
+def control_to_json(obj, default=None) -> dict:
+    """Returns the json form of a mapping dataclass, only with the fields that differ from the defaults."""
+    default = default if default is not None else type(obj)()
+    data = {}
+    for f in fields(obj):
+        if not f.init:
+            continue
+        value, default_value = getattr(obj, f.name), getattr(default, f.name)
+        if value == default_value:
+            continue
+        if isinstance(value, LedColor):
+            value = [value.r, value.g, value.b]
+        elif is_dataclass(value):
+            value = control_to_json(value)
+        elif isinstance(value, Enum):
+            value = value.name
+        data[f.name] = value
+    return data
+
+
+def export_json(path: str):
+    """Write the python mapping as a json mapping source."""
+    plugins = read_source(PY_SOURCE)
+    data = {"plugins": {
+        name: {str(cc): control_to_json(control) for cc, control in controls.items()}
+        for name, controls in plugins.items()
+    }}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4)
+    print(f"Exported {len(plugins)} plugins to {path}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--export":
+        export_json(sys.argv[2])
+    else:
+        registry = MappingRegistry()
+        print(f"Indexed {len(registry.index)} plugins from {len(registry.stamps)} mapping shards in {CACHE_DIR}")
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+FL Modular Grid - Control Intech or any other midi devices
+Copyright (C) 2024-2025  Tom Simonart
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Midi trace recorder and replayer.
+#
+# The recorder keeps the midi messages received and sent by the script in a preallocated ring buffer
+# of fixed-width records, the hot path only packs a record into it. The records are appended to a
+# trace file by flush(), called from OnIdle.
+#
+# Trace file: MAGIC, then records of (monotonic time (s), direction, status, data1, data2, port).
+#
+# Usage:
+#   python midi_trace.py dump TRACE
+#   python midi_trace.py replay TRACE [--realtime] [--plugin NAME]   (replays in the simulator, see fl_sim.py)
+
+import argparse
+import contextlib
+import io
+import os
+import struct
+from time import monotonic, strftime
+from typing import Iterator
+
+MAGIC = b"FLMT\x01"
+RECORD = struct.Struct("<dBBBBB")  # 13 bytes
+IN = 0  # Received from the controller
+OUT = 1  # Sent to the controller
+RING_SIZE = 4096  # Records kept between two flushes
+TRACE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "traces")
+
+
+class TraceRecorder:
+    """Ring buffer of midi records, written to a trace file on flush."""
+
+    def __init__(self, path: str, capacity: int = RING_SIZE):
+        self.path = path
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * RECORD.size)
+        self.written = 0  # Total records written in the ring
+        self.flushed = 0  # Total records flushed (or dropped)
+        self.dropped = 0  # Records overwritten before a flush
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(MAGIC)
+
+    def record(self, direction: int, status: int, data1: int, data2: int, port: int = 0):
+        RECORD.pack_into(self.buffer, self.written % self.capacity * RECORD.size,
+                         monotonic(), direction, status, data1 & 0xFF, data2 & 0xFF, port & 0xFF)
+        self.written += 1
+
+    def flush(self):
+        """Append the records since the last flush to the trace file."""
+        pending = self.written - self.flushed
+        if pending == 0:
+            return
+        if pending > self.capacity:
+            # Overwritten before being flushed
+            self.dropped += pending - self.capacity
+            self.flushed = self.written - self.capacity
+            pending = self.capacity
+        start = self.flushed % self.capacity * RECORD.size
+        end = start + pending * RECORD.size
+        view = memoryview(self.buffer)
+        with open(self.path, "ab") as f:
+            if end <= len(self.buffer):
+                f.write(view[start:end])
+            else:
+                f.write(view[start:])
+                f.write(view[:end - len(self.buffer)])
+        self.flushed = self.written
+
+
+def new_trace_path() -> str:
+    """Path of a new trace file named after the current time, with a counter when that name is taken."""
+    base = os.path.join(TRACE_DIR, strftime("trace-%Y%m%d-%H%M%S"))
+    path = base + ".bin"
+    n = 1
+    while os.path.exists(path):
+        path = f"{base}-{n}.bin"
+        n += 1
+    return path
+
+
+def read_trace(path: str) -> Iterator[tuple[float, int, int, int, int, int]]:
+    """Yields the records of a trace file, (time, direction, status, data1, data2, port)."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{path} is not a midi trace")
+    end = len(data) - (len(data) - len(MAGIC)) % RECORD.size
+    yield from RECORD.iter_unpack(memoryview(data)[len(MAGIC):end])
+
+
+def dump(path: str):
+    records = list(read_trace(path))
+    start = records[0][0] if records else 0.0
+    for t, direction, status, data1, data2, port in records:
+        print(f"{t - start:10.4f}  {'in ' if direction == IN else 'out'}  port {port:<3} "
+              f"ch {status & 0xF:<2} {status >> 4:X}  {data1:>3} {data2:>3}")
+
+
+def replay(path: str, plugin: str, realtime: bool = False):
+    """Feed the received messages of a trace to the script in the simulator, and compare what it sends back."""
+    from fl_sim import START_TIME, Simulator, VirtualPlugin
+    records = list(read_trace(path))
+    if not records:
+        print("Empty trace")
+        return
+    start = records[0][0]
+    with contextlib.redirect_stdout(io.StringIO()):
+        sim = Simulator(VirtualPlugin.from_mapping(plugin), realtime=realtime)
+        sim.focus()
+        offset = sim.now - START_TIME
+        for t, direction, status, data1, data2, port in records:
+            if direction == IN:
+                sim.advance(offset + t - start)
+                sim.port = port
+                sim.send(status, data1, data2)
+        sim.advance(offset + records[-1][0] - start + 0.5)
+    # Sysex messages are recorded as their size (data1 = size & 0x7F, data2 = size >> 7)
+    recorded_out = [tuple(record[2:5]) for record in records if record[1] == OUT and record[2] != 0xF0]
+    recorded_sysex = [record[3] | record[4] << 7 for record in records if record[1] == OUT and record[2] == 0xF0]
+    received = len(sim.latencies["OnMidiIn"])
+    print(f"Replayed {received} messages over {records[-1][0] - start:.2f} s")
+    print(f"Midi out: {len(sim.midi_out)} replayed, {len(recorded_out)} recorded")
+    for i, (replayed, recorded) in enumerate(zip(sim.midi_out, recorded_out)):
+        if replayed != recorded:
+            print(f"First difference at midi out message {i}: replayed {replayed}, recorded {recorded}")
+            break
+    if sim.sysex_out or recorded_sysex:
+        print(f"Sysex out: {len(sim.sysex_out)} replayed, {len(recorded_sysex)} recorded")
+        for i, (replayed, recorded) in enumerate(zip(sim.sysex_out, recorded_sysex)):
+            if len(replayed) & 0x3FFF != recorded:
+                print(f"First difference at sysex out message {i}: replayed {len(replayed)} bytes, recorded {recorded} bytes")
+                break
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dump or replay a midi trace.")
+    parser.add_argument("command", choices=("dump", "replay"))
+    parser.add_argument("trace")
+    parser.add_argument("--plugin", help="mapped plugin focused during the replay")
+    parser.add_argument("--realtime", action="store_true", help="replay at the recorded speed")
+    args = parser.parse_args()
+    if args.command == "dump":
+        dump(args.trace)
+    else:
+        if not args.plugin:
+            parser.error("replay needs the --plugin focused while recording")
+        replay(args.trace, args.plugin, args.realtime)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The scripts live at the root of the repository, next to the FL Studio modules they are loaded with
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
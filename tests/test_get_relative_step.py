@@ -0,0 +1,95 @@
+"""
+Equivalence of get_relative_step with the step scan it replaced, runs without FL Studio (see fl_sim.py).
+"""
+import random
+from functools import lru_cache
+
+import pytest
+
+from fl_sim import Simulator
+
+R_STEP_PRECISION = 5
+SEED = 2025
+
+
+@lru_cache(maxsize=None)
+def reference_current_step(value: float, step_diff: float) -> int:
+    """The linear scan of the previous get_relative_step, cached as it does not depend on the speed."""
+    # Get current step
+    current_step = 0
+    LOOP_MAX = 4095
+    loop_n = 0
+    value = round(value, R_STEP_PRECISION)
+    while value > round(step_diff * current_step, R_STEP_PRECISION):
+        if loop_n == LOOP_MAX:  # Avoid infinite loops
+            raise Exception("Infinite loop in stepper")
+        current_step += 1
+        loop_n += 1
+    return current_step
+
+
+def reference_relative_step(value: float, steps: int, speed: int, min_: float = 0.0, max_: float = 1.0, rollover=False) -> float:
+    """get_relative_step before the closed-form current step."""
+    step_diff = (max_ - min_) / (steps - 1)
+    current_step = reference_current_step(value, step_diff)
+
+    if rollover and current_step + speed >= steps:
+        speed = -1 * (current_step + speed - 1)
+    elif current_step + speed >= steps:
+        speed = steps - current_step - 1
+    elif current_step + speed < 0:
+        speed = 0 - current_step
+    clamped_value = round((current_step + speed) * step_diff, R_STEP_PRECISION)
+    return clamped_value
+
+
+@pytest.fixture(scope="module")
+def get_relative_step():
+    return Simulator().script.get_relative_step
+
+
+def sample_values(rng: random.Random, steps: int, n: int) -> list[float]:
+    """Random values, and values on and around the rounded value of random steps."""
+    step_diff = 1 / (steps - 1)
+    values = [rng.random() for _ in range(n)]
+    for _ in range(n):
+        value = round(rng.randrange(steps) * step_diff, R_STEP_PRECISION)
+        values += (value, value - 1e-5, value + 1e-5, value - 6e-6, value + 4e-6)
+    return values
+
+
+def assert_equivalent(get_relative_step, value, steps, speed, rollover):
+    try:
+        expected = reference_relative_step(value, steps, speed, rollover=rollover)
+    except Exception:
+        with pytest.raises(ValueError):
+            get_relative_step(value, steps, speed, rollover=rollover)
+        return
+    assert get_relative_step(value, steps, speed, rollover=rollover) == expected, (value, steps, speed, rollover)
+
+
+def test_every_step_count(get_relative_step):
+    rng = random.Random(SEED)
+    for steps in range(2, 4097):
+        for value in sample_values(rng, steps, 1)[:4]:
+            for speed in (-steps - 1, -steps, -1, 0, 1, steps, steps + 1):
+                for rollover in (False, True):
+                    assert_equivalent(get_relative_step, value, steps, speed, rollover)
+
+
+@pytest.mark.parametrize("steps", [2, 3, 4, 5, 7, 10, 100, 127, 128, 254, 255, 256, 1000, 1023, 1024, 4095, 4096])
+def test_common_step_counts(get_relative_step, steps):
+    rng = random.Random(SEED + steps)
+    for value in sample_values(rng, steps, 10) + [-0.5, -1e-6, 0.0, 1.0, 1 + 1e-6]:
+        for speed in (-steps, -1, 0, 1, 2, steps):
+            for rollover in (False, True):
+                assert_equivalent(get_relative_step, value, steps, speed, rollover)
+
+
+def test_out_of_range(get_relative_step):
+    # Beyond the last scanned step, both fail
+    for value in (1.0001, 1.5, 2.0):
+        with pytest.raises(Exception):
+            reference_relative_step(value, 4096, 1)
+        with pytest.raises(ValueError):
+            get_relative_step(value, 4096, 1)